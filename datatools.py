@@ -0,0 +1,233 @@
+"""
+All functions for saving and loading detections and extracted data
+"""
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from tracking import boxCorners, cleanBoxes
+
+box_columns = ("cx", "cy", "w", "h", "angle")
+
+def packContours(contours):
+    """
+    Flatten {frame: [box2D, ...]} into typed columns plus a frame offset index.
+
+    Returns (boxes, offsets): boxes is an (N, 5) float32 array of
+    [cx, cy, w, h, angle] and the boxes of frame f are boxes[offsets[f]:offsets[f+1]].
+    Frames are numbered 0..max(frame), missing frames are empty. NaN padding
+    from CSV round trips is dropped. Frames may also already be (n, 5) arrays.
+    """
+    frame_count = max(contours.keys()) + 1 if len(contours) > 0 else 0
+    counts = np.zeros(frame_count, dtype=np.int64)
+    parts = [np.empty((0, 5))]
+    for frame_index in range(frame_count):
+        _, boxes = cleanBoxes(contours.get(frame_index, []))
+        counts[frame_index] = len(boxes)
+        parts.append(boxes)
+    boxes = np.concatenate(parts).astype(np.float32)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return boxes, offsets
+
+def unpackContours(boxes, offsets):
+    """
+    Inverse of packContours: {frame: [box2D, ...]} with box2D tuples as cv2 returns them.
+    """
+    contours = {}
+    rows = boxes.astype(np.float64).tolist()
+    for frame_index in range(len(offsets) - 1):
+        contours[frame_index] = [((cx, cy), (w, h), angle) for cx, cy, w, h, angle in rows[offsets[frame_index]:offsets[frame_index+1]]]
+    return contours
+
+def contoursFromArrays(boxes, offsets):
+    """
+    {frame: (n, 5) array view} over packed boxes, which onlineTracker.push and
+    trackObjects consume directly without building box2D tuples.
+    """
+    return {frame_index: boxes[offsets[frame_index]:offsets[frame_index+1]] for frame_index in range(len(offsets) - 1)}
+
+def convertFromStrings(contour_data):
+    """
+    Parse a contour DataFrame read from a _c.csv file (one column per frame,
+    each cell a stringified box2D, NaN padding) in bulk.
+
+    All non-empty cells are joined column by column into one string, brackets and
+    commas become whitespace, and the numbers are converted in a single pass,
+    five per box. Returns (boxes, offsets) as packContours does.
+    """
+    print("Converting strings to boxes...")
+    frames = np.array([int(frame_index) for frame_index in contour_data.columns])
+    order = np.argsort(frames, kind='stable')
+    cells = contour_data.to_numpy(dtype=object)[:, order]
+    present = pd.notna(cells)
+    frame_count = frames.max() + 1 if len(frames) > 0 else 0
+    counts = np.zeros(frame_count, dtype=np.int64)
+    counts[frames[order]] = present.sum(axis=0)
+    text = " ".join(cells.T[present.T].tolist()).translate(str.maketrans("(),[]", "     "))
+    values = np.array(text.split(), dtype=np.float64)
+    if len(values) != 5 * counts.sum():
+        raise ValueError(f"Expected 5 numbers per box, got {len(values)} numbers for {counts.sum()} boxes")
+    return values.reshape(-1, 5), np.concatenate(([0], np.cumsum(counts)))
+
+def readContourCSV(path):
+    contour_data = pd.read_csv(path, index_col=0, dtype=str)
+    return convertFromStrings(contour_data)
+
+def saveDetectionStore(path, boxes, offsets):
+    """
+    Write packed boxes as a detection store directory: boxes.bin holds raw float32
+    [cx, cy, w, h, angle] rows and offsets.bin the int64 frame offset index.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.asarray(boxes, dtype=np.float32).reshape(-1, 5).tofile(os.path.join(path, "boxes.bin"))
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(path, "offsets.bin"))
+
+def mapArray(path, dtype, width=None):
+    if os.path.getsize(path) == 0: # mmap refuses empty files
+        return np.empty((0, width) if width else 0, dtype=dtype)
+    array = np.memmap(path, dtype=dtype, mode='r')
+    return array.reshape(-1, width) if width else array
+
+class detectionStore():
+    """
+    Read-only, memory-mapped view of a detection store directory.
+
+    Indexing by frame returns an (n, 5) view of that frame's boxes, so only the
+    pages holding the requested frames are ever read. It exposes keys() and
+    [frame] like the contours dict, so trackObjects and trackChunks can read
+    from it directly.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.boxes = mapArray(os.path.join(path, "boxes.bin"), np.float32, 5)
+        self.offsets = mapArray(os.path.join(path, "offsets.bin"), np.int64)
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def keys(self):
+        return range(len(self))
+
+    def __getitem__(self, frame_index):
+        return self.boxes[self.offsets[frame_index]:self.offsets[frame_index+1]]
+
+    def frameRange(self, start, stop):
+        """
+        Boxes of frames start..stop-1 as one slice, with offsets relative to it.
+        """
+        offsets = np.array(self.offsets[start:stop+1])
+        return self.boxes[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+    def corners(self, frame_index):
+        """
+        Integer corner points of a frame's boxes, ready for cv2.drawContours overlays.
+        """
+        return np.intp(boxCorners(self[frame_index]).astype(np.float32))
+
+class detectionWriter():
+    """
+    Append-only writer for a detection store directory.
+
+    Boxes are buffered and written out in fixed-size chunks of chunk_rows rows,
+    so memory stays constant however long the video is. Frames are numbered
+    from 0 in the order they are appended. The store is written under
+    <path>.partial and only renamed to path by close(), so a recording that is
+    abandoned (discard()) or interrupted never looks like saved contours.
+    """
+    def __init__(self, path, chunk_rows=65536):
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        if os.path.exists(self.partial_path):
+            shutil.rmtree(self.partial_path)
+        os.makedirs(self.partial_path)
+        self.boxes_file = open(os.path.join(self.partial_path, "boxes.bin"), "wb")
+        self.offsets_file = open(os.path.join(self.partial_path, "offsets.bin"), "wb")
+        self.buffer = np.empty((chunk_rows, 5), dtype=np.float32)
+        self.buffered = 0
+        self.pending_offsets = [0] # offsets not yet written to disk
+        self.total = 0
+        self.frame_count = 0
+
+    def __len__(self):
+        return self.frame_count
+
+    def append(self, boxes2D):
+        _, boxes = cleanBoxes(boxes2D)
+        n = len(boxes)
+        if self.buffered + n > len(self.buffer):
+            self.flush()
+        if n > len(self.buffer): # larger than a whole chunk, write it straight through
+            boxes.astype(np.float32).tofile(self.boxes_file)
+        else:
+            self.buffer[self.buffered:self.buffered+n] = boxes
+            self.buffered += n
+        self.total += n
+        self.frame_count += 1
+        self.pending_offsets.append(self.total)
+        if len(self.pending_offsets) >= len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.buffer[:self.buffered].tofile(self.boxes_file) # boxes first, so offsets on disk never point past them
+        self.boxes_file.flush()
+        np.array(self.pending_offsets, dtype=np.int64).tofile(self.offsets_file)
+        self.offsets_file.flush()
+        self.pending_offsets.clear()
+        self.buffered = 0
+
+    def close(self):
+        """
+        Finish the store and move it into place at path.
+        """
+        if self.boxes_file.closed:
+            return
+        self.flush()
+        self.boxes_file.close()
+        self.offsets_file.close()
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.partial_path, self.path)
+
+    def discard(self):
+        """
+        Abandon an unfinished store. Does nothing once close() has moved it into place.
+        """
+        if self.boxes_file.closed:
+            return
+        self.boxes_file.close()
+        self.offsets_file.close()
+        shutil.rmtree(self.partial_path, ignore_errors=True)
+
+def loadContourArrays(path):
+    """
+    (boxes, offsets) from saved contours: a detection store directory (memory
+    mapped), a _c.npz or a _c.csv file.
+    """
+    if os.path.isdir(path):
+        store = detectionStore(path)
+        return store.boxes, store.offsets
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            return np.column_stack([archive[name] for name in box_columns]), archive["offsets"]
+    return readContourCSV(path)
+
+def saveContours(path, contours):
+    boxes, offsets = packContours(contours)
+    np.savez(path, offsets=offsets, **{name: boxes[:, k] for k, name in enumerate(box_columns)})
+
+def loadContours(path):
+    return unpackContours(*loadContourArrays(path))
+
+def saveData(path, dataframe):
+    """
+    Save long-format extracted data as typed columns: int32 ids and frames, float32 values.
+    """
+    columns = {}
+    for name in dataframe.columns:
+        values = dataframe[name].to_numpy()
+        columns[str(name)] = values.astype(np.int32 if np.issubdtype(values.dtype, np.integer) else np.float32)
+    np.savez(path, **columns)
+
+def loadData(path):
+    with np.load(path) as archive:
+        return pd.DataFrame({name: archive[name] for name in archive.files})
@@ -0,0 +1,125 @@
+"""
+Durable per-video state of batch runs, kept in the save directory so interrupted batches resume
+"""
+import os
+import sqlite3
+from time import time
+from contextlib import contextmanager
+from resultcache import settingsHash, detection_keys, tracking_keys
+
+job_states = ("pending", "recording", "tracking", "done", "failed")
+
+class jobQueue():
+    """
+    SQLite journal of the videos in a batch: <save directory>/jobs.sqlite.
+
+    Videos are added as pending, move to recording while frames are detected
+    and to tracking while tracks are finalized and saved, and end done or
+    failed. Starting the batch again skips videos done with the same settings
+    and save format (changing either queues them again), reruns videos left in
+    recording or tracking by a crash, and retries failed videos. A failure or a
+    crash counts as an attempt, a stop asked for by the user (requeue) does not;
+    a video is given up on after max_attempts. Every call opens its own
+    connection, so the queue can be passed to worker processes and used from
+    any thread.
+    """
+    def __init__(self, save_directory, max_attempts=3):
+        os.makedirs(save_directory, exist_ok=True)
+        self.path = os.path.join(save_directory, "jobs.sqlite")
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (file TEXT PRIMARY KEY, state TEXT NOT NULL, config TEXT, "
+                       "attempts INTEGER NOT NULL DEFAULT 0, tracks INTEGER, error TEXT, updated REAL)")
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60) # parallel workers take turns writing
+        try:
+            with db: # commit, or roll back on error
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def jobKey(file):
+        return os.path.abspath(file)
+
+    @staticmethod
+    def configHash(settings, file_format="csv", wide=False):
+        return settingsHash(dict(settings, file_format=file_format, wide=wide),
+                            detection_keys + tracking_keys + ("file_format", "wide"))
+
+    def add(self, files, settings, file_format="csv", wide=False):
+        """
+        Queue files, resetting those last run with other settings. Returns the files still to run.
+        """
+        config = self.configHash(settings, file_format, wide)
+        with self.connect() as db:
+            for file in files:
+                key = self.jobKey(file)
+                row = db.execute("SELECT config, state FROM jobs WHERE file = ?", (key,)).fetchone()
+                if row is None:
+                    db.execute("INSERT INTO jobs (file, state, config, updated) VALUES (?, 'pending', ?, ?)", (key, config, time()))
+                elif row[0] != config:
+                    db.execute("UPDATE jobs SET state = 'pending', config = ?, attempts = 0, tracks = NULL, error = NULL, "
+                               "updated = ? WHERE file = ?", (config, time(), key))
+                elif row[1] in ("recording", "tracking"): # left behind by a crash, so a video that keeps crashing the run is given up on
+                    db.execute("UPDATE jobs SET state = 'pending', attempts = attempts + 1, error = 'interrupted', "
+                               "updated = ? WHERE file = ?", (time(), key))
+        return self.runnable(files)
+
+    def runnable(self, files):
+        """
+        The given files that are not done and have attempts left, in order.
+        """
+        jobs = self.jobs()
+        return [file for file in files if self.jobKey(file) not in jobs
+                or (jobs[self.jobKey(file)]["state"] != "done" and jobs[self.jobKey(file)]["attempts"] < self.max_attempts)]
+
+    def setState(self, file, state, tracks=None):
+        if state not in job_states:
+            raise ValueError(f"Unknown job state: {state}")
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state = ?, tracks = COALESCE(?, tracks), error = CASE WHEN ? = 'done' THEN NULL ELSE error END, "
+                       "updated = ? WHERE file = ?", (state, tracks, state, time(), self.jobKey(file)))
+
+    def fail(self, file, error):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state = 'failed', attempts = attempts + 1, error = ?, updated = ? WHERE file = ?",
+                       (str(error), time(), self.jobKey(file)))
+
+    def requeue(self, files, states=("recording", "tracking")):
+        """
+        Return videos stopped by the user in one of states to pending, without counting an attempt.
+        """
+        placeholders = ", ".join("?" * len(states))
+        with self.connect() as db:
+            db.executemany(f"UPDATE jobs SET state = 'pending', updated = ? WHERE file = ? AND state IN ({placeholders})",
+                           [(time(), self.jobKey(file), *states) for file in files])
+
+    def retryFailed(self):
+        """
+        Give failed videos, including those out of attempts, a fresh set of attempts.
+        """
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state = 'pending', attempts = 0, updated = ? WHERE state IN ('pending', 'failed')", (time(),))
+
+    def jobs(self):
+        """
+        {file: {state, attempts, tracks, error}} of every video in the journal.
+        """
+        with self.connect() as db:
+            rows = db.execute("SELECT file, state, attempts, tracks, error FROM jobs").fetchall()
+        return {file: {"state": state, "attempts": attempts, "tracks": tracks, "error": error}
+                for file, state, attempts, tracks, error in rows}
+
+    def summary(self, files=None):
+        """
+        Count of videos in each state, over the given files or the whole journal.
+        """
+        jobs = self.jobs()
+        keys = jobs.keys() if files is None else [self.jobKey(file) for file in files if self.jobKey(file) in jobs]
+        counts = dict.fromkeys(job_states, 0)
+        for key in keys:
+            counts[jobs[key]["state"]] += 1
+        return counts
@@ -16,7 +16,8 @@ from collections import defaultdict, deque
 import inspect
 
 myappid = 'nil.npm.pyqt.3' # arbitrary string
-ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+if sys.platform == "win32": # taskbar grouping, windll only exists on Windows
+    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 
 from importlib import reload
 import json
@@ -28,11 +29,17 @@ from ui_light import *
 from scaleBar import scaleBar
 from videotools import ScaleBar, nearestOdd
 from qtools import *
+from pipeline import portableSettings, video_formats
+from jobqueue import jobQueue
 from video_loader import processVideos
 
 class MainWindow(QMainWindow, Ui_MainWindow):
     settings_signal = Signal(tuple)
     save_signal = Signal(str)
+    layout_signal = Signal(bool)
+    format_signal = Signal(str)
+    batch_signal = Signal(list, dict, str, str, bool, int)
+    jobs_signal = Signal(object)
     
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -48,7 +55,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.videoDisplay.setAlignment(Qt.AlignCenter)
         self.pauseButton.clicked.connect(self.pauseDisplay)
         self.playButton.clicked.connect(self.resumeDisplay)
-        self.recordButton.clicked.connect(self.emitSettings)
+        self.recordButton.clicked.connect(self.onRecord)
         self.videoLoader = None
         
         self.actionEdit.triggered.connect(self.onEditScaleBar)
@@ -61,6 +68,33 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.actionBounding_Boxes_2.triggered.connect(self.emitSettings)
         self.action20x.triggered.connect(self.on20x)
         self.action60x.triggered.connect(self.on60x)
+        self.actionMinTrackLength = QAction("Minimum Track Length", self)
+        self.actionMinTrackLength.setStatusTip("Tracks shorter than this many frames are discarded")
+        self.actionMinTrackLength.triggered.connect(self.onMinTrackLength)
+        self.menuClear.addAction(self.actionMinTrackLength)
+        self.actionParallelVideos = QAction("Parallel Workers", self)
+        self.actionParallelVideos.setStatusTip("Batch record on this many processes: one video each, or frame ranges of a single video (no live display)")
+        self.actionParallelVideos.triggered.connect(self.onParallelVideos)
+        self.menuClear.addAction(self.actionParallelVideos)
+        self.actionSaveSettings = QAction("Save Settings...", self)
+        self.actionSaveSettings.setStatusTip("Save the filter settings as JSON for headless recording (record.py)")
+        self.actionSaveSettings.triggered.connect(self.onSaveSettings)
+        self.menuClear.addAction(self.actionSaveSettings)
+        self.actionRetryFailed = QAction("Retry Failed Videos", self)
+        self.actionRetryFailed.setStatusTip("Give videos that failed in the save directory's batch a fresh set of attempts")
+        self.actionRetryFailed.triggered.connect(self.onRetryFailed)
+        self.menuClear.addAction(self.actionRetryFailed)
+        self.actionWideLayout = QAction("Wide Data Layout (legacy)", self, checkable=True)
+        self.actionWideLayout.setStatusTip("Save extracted data as one column per frame instead of one row per detection")
+        self.menuClear.addAction(self.actionWideLayout)
+        self.menuSaveFormat = self.menuClear.addMenu("Save Format")
+        self.saveFormatGroup = QActionGroup(self)
+        for label, file_format in (("CSV", "csv"), ("Binary (.npz)", "npz"), ("Detection Store (.det)", "det")):
+            action = QAction(label, self, checkable=True)
+            action.setObjectName(file_format)
+            action.setChecked(file_format == "csv")
+            self.saveFormatGroup.addAction(action)
+            self.menuSaveFormat.addAction(action)
         self.subBackMethod.currentIndexChanged.connect(self.subtractBackgroundFunction)
         self.invertLabel.setEnabled(True)
         self.invertToggle.setEnabled(True)
@@ -122,32 +156,40 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.posX, self.posY = 5, 5
         self.divisions = 5
         self.fontScale = 1.5
+        self.minTrackLength = 30
+        self.parallelVideos = 1
+        self.batch_running = False
         self.dim = (640, 480)
         self.scaleBarDialog = ScaleBar(self.dim[1], self.dim[0], self.pixToum)
         self.scaleBarDialog.valuesUpdated.connect(self.updateValues)
         self.onSubBack()
 
-        self.video_formats = [
-            "avi",
-            "mp4",
-            "mov",
-            "mkv",
-            "wmv",
-            "flv",
-            "mpeg",
-            "mpg",
-        ]
+        self.video_formats = list(video_formats)
         self.video_files=[]
+        self.jobs = None # journal of the running batch, see startJobs
         self.load_directory=''
         self.save_directory=os.getcwd()
         self.csvThread = QThread()
         self.csvSaver = csvSaver(self.save_directory)
         self.csvSaver.moveToThread(self.csvThread)
+        self.csvSaver.job_status.connect(self.onJobStatus)
         self.save_signal.connect(self.csvSaver.setSaveDirectory)
+        self.layout_signal.connect(self.csvSaver.setWideLayout)
+        self.actionWideLayout.toggled.connect(self.layout_signal.emit)
+        self.format_signal.connect(self.csvSaver.setFileFormat)
+        self.jobs_signal.connect(self.csvSaver.setJobQueue)
+        self.saveFormatGroup.triggered.connect(lambda action: self.format_signal.emit(action.objectName()))
         self.csvThread.start()
+        self.batchThread = QThread()
+        self.batchRecorder = batchRecorder()
+        self.batchRecorder.moveToThread(self.batchThread)
+        self.batch_signal.connect(self.batchRecorder.record)
+        self.batchRecorder.video_done.connect(self.onBatchVideoDone)
+        self.batchRecorder.batch_finished.connect(self.onBatchFinished)
+        self.batchThread.start()
 
-    def emitSettings(self):
-        settings = {
+    def currentSettings(self):
+        return {
                     "adaptToggle": self.adaptToggle.isChecked(),
                     "adaptMethod": self.adaptMethod.currentText(),
                     "adaptArea": self.area_value,
@@ -165,17 +207,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                     "subBackToggle": self.subBackToggle.isChecked(),
                     "subBackModels": self.subBackModels,
                     "subBackMethod": self.subBackMethod.currentText(),
+                    "subBackVal": self.subBackVal,
                     "frameDiffToggle": self.frameDiffToggle.isChecked(),
                     "frameDiffValue": self.frameDiffValue.value(),
                     "frameDiffValueMax": self.frameDiffValueMax.value(),
                     "showFPS": self.actionFPS.isChecked(),
                     "showOriginal": self.actionOriginal_Frame.isChecked(),
                     "drawContours": self.actionBounding_Boxes_2.isChecked(),
-                    "batchRecord": self.recordButton.isChecked()}
-        
+                    "minTrackLength": self.minTrackLength,
+                    "batchRecord": self.recordButton.isChecked() and not self.batch_running}
+
+    def emitSettings(self):
+        settings = self.currentSettings()
         if self.videoLoader is not None:
             self.settings_signal.emit(settings)
     
+    def onJobStatus(self, filename, status):
+        self.statusbar.showMessage(f'{filename.split(".")[0]}: {status}', 10000)
+
     def updateDisplay(self, frame):
         if frame is not None:
             try:
@@ -241,6 +290,107 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def on60x(self):
         self.pixToum = 1/0.083
+
+    def onMinTrackLength(self):
+        value, ok = QInputDialog.getInt(self, "Tracking", "Minimum track length (frames):", self.minTrackLength, 2, 1000000)
+        if ok:
+            self.minTrackLength = value
+            self.emitSettings()
+        
+    def onParallelVideos(self):
+        value, ok = QInputDialog.getInt(self, "Batch Recording", "Worker processes:", self.parallelVideos, 1, os.cpu_count())
+        if ok:
+            self.parallelVideos = value
+
+    def onSaveSettings(self):
+        file, _ = QFileDialog.getSaveFileName(self, "Save Settings", os.path.join(self.save_directory, "settings.json"), "Settings (*.json)")
+        if file:
+            settings = portableSettings(self.currentSettings())
+            del settings["batchRecord"]
+            with open(file, "w") as f:
+                json.dump(settings, f, indent=4)
+            print(f"Saved settings to: {file}")
+
+    def onRecord(self, checked):
+        if self.batch_running:
+            if not checked: # videos in progress finish, the rest stay queued for the next run
+                print("Stopping batch after the videos in progress...")
+                self.batchRecorder.stop()
+            else: # still stopping
+                self.recordButton.setChecked(False)
+            return
+        if checked and len(self.video_files) > 0 and not self.startJobs():
+            return
+        if not checked and self.jobs is not None: # stopped by the user, not an attempt
+            self.jobs.requeue(self.video_files)
+        if checked and self.parallelVideos > 1 and len(self.video_files) > 0:
+            if self.videoLoader is not None:
+                self.videoLoader.stop()
+            self.videoDisplay.setPixmap(self.blank)
+            self.batch_running = True
+            file_format = self.saveFormatGroup.checkedAction().objectName()
+            self.batch_signal.emit(list(self.video_files), self.currentSettings(), self.save_directory, file_format,
+                                   self.actionWideLayout.isChecked(), self.parallelVideos)
+            return
+        self.emitSettings()
+
+    def startJobs(self):
+        """
+        Open the save directory's job queue and drop the loaded videos it has
+        already recorded with these settings. Returns False if none are left.
+        """
+        try:
+            self.jobs = jobQueue(self.save_directory)
+            runnable = self.jobs.add(self.video_files, self.currentSettings(), self.saveFormatGroup.checkedAction().objectName(),
+                                     self.actionWideLayout.isChecked())
+        except Exception as e: # an unwritable save directory should not stop recording
+            print(f"Job queue unavailable: {e}")
+            self.jobs = None
+            self.jobs_signal.emit(None)
+            return True
+        self.jobs_signal.emit(self.jobs) # csvSaver marks videos tracking, done or failed as it saves them
+        for file in [f for f in self.video_files if f not in runnable]:
+            print(f"Skipping {os.path.basename(file)}: already done or out of attempts (see {self.jobs.path})")
+            self.removeVideo(file)
+        if len(self.video_files) == 0:
+            self.recordButton.setChecked(False)
+            self.videoDisplay.setPixmap(self.blank)
+            print("No more videos!")
+            return False
+        if self.parallelVideos > 1: # recordBatch journals the parallel batch itself
+            return True
+        current = self.videoLoader.file if self.videoLoader is not None and self.videoLoader.capExists() else None
+        if current not in self.video_files:
+            current = self.video_files[0]
+            for action in self.menuVideos.actions():
+                action.setChecked(action.objectName() == current)
+            self.checkVideoLoader(restart=True)
+            self.videoLoader.loadVideo(current)
+        self.jobs.setState(current, "recording")
+        return True
+
+    def onRetryFailed(self):
+        try:
+            jobQueue(self.save_directory).retryFailed()
+            print(f"Failed videos in {self.save_directory} will be retried")
+        except Exception as e:
+            print(f"Job queue unavailable: {e}")
+
+    def removeVideo(self, file):
+        if file in self.video_files:
+            self.video_files.remove(file)
+        for action in self.menuVideos.actions():
+            if action.objectName() == file:
+                self.menuVideos.removeAction(action)
+
+    def onBatchVideoDone(self, file, status):
+        self.statusbar.showMessage(f'{os.path.basename(file).split(".")[0]}: {status}', 10000)
+        self.removeVideo(file)
+
+    def onBatchFinished(self):
+        self.batch_running = False
+        self.recordButton.setChecked(False)
+        print("No more videos!")
         
     def thresholdFunction(self, *args):
         self.thresholdVal = (self.thresholdValue.value()/100)*255
@@ -351,6 +501,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.restartButton.clicked.connect(self.videoLoader.restartVideo)
         self.videoLoader.frame_out.connect(self.updateDisplay)
         self.videoLoader.contours_out.connect(self.csvSaver.save)
+        self.videoLoader.setSaveDirectory(self.save_directory)
+        self.save_signal.connect(self.videoLoader.setSaveDirectory)
         self.videoLoader.name_out.connect(self.manageVideos)
         self.settings_signal.connect(self.videoLoader.loadSettings)
         self.emitSettings()
@@ -371,6 +523,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                     action.setChecked(True)
                     self.checkVideoLoader(restart=True)
                     self.videoLoader.loadVideo(object_name)
+                    if self.jobs is not None:
+                        self.jobs.setState(object_name, "recording")
                     if found_action:
                         break
             else:
@@ -431,12 +585,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         try:
             self._running=False
             event.accept() 
+            self.batchRecorder.stop() # start no more batch videos, otherwise closing waits for the whole batch
             if self.videoLoader is not None:
                 self.videoLoader.stop()
             if self.csvSaver is not None:
                 self.csvSaver.closeThreads()
+            if self.jobs is not None: # closing is a stop, not a failed attempt; saves finished above are already done
+                self.jobs.requeue(self.video_files, states=("recording",))
             self.csvThread.quit()
             self.csvThread.wait()
+            self.batchThread.quit()
+            self.batchThread.wait()
             super().closeEvent(event)
         except Exception as e:
             msg = f"Error during close event: {e}"
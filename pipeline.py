@@ -0,0 +1,437 @@
+"""
+Qt-free decode, filter and detection pipeline, and the parallel batch engine
+"""
+import os
+import cv2
+import glob
+import json
+import queue
+import threading
+import numpy as np
+from time import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from tracking import onlineTracker, cleanBoxes
+from datatools import detectionWriter
+from processing import threads, processData, pool
+from resultcache import resultCache
+from jobqueue import jobQueue
+
+video_formats = ("avi", "mp4", "mov", "mkv", "wmv", "flv", "mpeg", "mpg")
+
+# the GUI's startup values, with frame differencing (detection) switched on
+default_settings = {"adaptToggle": False, "adaptMethod": "Mean", "adaptArea": 21, "adaptValueC": 4,
+                    "autoToggle": False, "invertToggle": False, "thresholdToggle": False, "thresholdVal": 0,
+                    "embossToggle": False, "embossVal": 1, "blurToggle": False, "blurVal": 1,
+                    "dilationToggle": False, "dilateVal": 0, "subBackToggle": False, "subBackMethod": "MOG2",
+                    "subBackVal": 0, "frameDiffToggle": True, "frameDiffValue": 25, "frameDiffValueMax": 100,
+                    "minTrackLength": 30}
+
+def loadSettings(path):
+    """
+    Filter settings from a JSON file (as saved from Tools > Save Settings), on
+    top of default_settings.
+    """
+    with open(path) as f:
+        loaded = json.load(f)
+    unknown = set(loaded) - set(default_settings) - {"showFPS", "showOriginal", "drawContours", "batchRecord"}
+    if unknown:
+        print(f"Ignoring unknown settings: {', '.join(sorted(unknown))}")
+    settings = dict(default_settings)
+    settings.update({key: value for key, value in loaded.items() if key in default_settings})
+    settings["blurVal"] = int(settings["blurVal"]) | 1 # GaussianBlur needs an odd kernel, as nearestOdd ensures in the GUI
+    return settings
+
+def videoFiles(paths):
+    """
+    Video files in the given directories, glob patterns or file paths, sorted.
+    """
+    files = []
+    for path in paths:
+        candidates = [os.path.join(path, name) for name in os.listdir(path)] if os.path.isdir(path) else glob.glob(path)
+        files.extend(f for f in candidates if os.path.isfile(f) and f.split(".")[-1].lower() in video_formats)
+    return sorted(set(files))
+
+def frameDifferencing(frame, area_min: int=25, area_max: int=100):
+    boxes, boxes2D, centers = [], [], []
+
+    contours, hierarchy = cv2.findContours(frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area < area_min or area > area_max * 3:
+            continue
+        box2D = cv2.minAreaRect(contour)
+        box = cv2.boxPoints(box2D)
+        box = np.intp(box)
+        boxes.append(box)
+        boxes2D.append(box2D)
+        centers.append(np.intp(box2D[0]))
+
+    return boxes, centers, boxes2D
+
+def createSubtractor(method, value, history=450):
+    """
+    Background subtractor as MainWindow.onSubBack builds it, for value in 0..1.
+    """
+    if method == "MOG2":
+        return cv2.createBackgroundSubtractorMOG2(history=history, varThreshold=16+48*value, detectShadows=False)
+    if method == "KNN":
+        return cv2.createBackgroundSubtractorKNN(dist2Threshold=100+500*value, history=history, detectShadows=False)
+    return None
+
+def applyFilters(frame, settings, subtractor=None):
+    """
+    Run the filter chain selected in settings on one frame.
+
+    Returns the filtered grayscale frame and the boxes, centers and box2Ds
+    found by frameDifferencing. subtractor is the background model used when
+    subBackToggle is set; it carries state from frame to frame.
+    """
+    boxes, centers, boxes2D = [], [], []
+    if len(frame.shape) == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    if settings["blurToggle"]:
+        frame = cv2.GaussianBlur(frame, (settings["blurVal"], settings["blurVal"]), 0)
+
+    if settings["adaptToggle"]:
+        method = settings["adaptMethod"]
+        if method == "Mean":
+            frame = cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                          settings["adaptArea"], settings["adaptValueC"])
+        elif method == "Gaussian":
+            frame = cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                          settings["adaptArea"], settings["adaptValueC"])
+
+    if settings["thresholdToggle"]:
+        if settings["autoToggle"]:
+            otsu, frame = cv2.threshold(frame, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        else:
+            _, frame = cv2.threshold(frame, settings["thresholdVal"], 255, cv2.THRESH_BINARY)
+
+    if settings["subBackToggle"]:
+        method = settings["subBackMethod"]
+        if method == "MOG2":  # Mixture of Gaussians 2
+            frame = subtractor.apply(frame, learningRate=0.001)
+        if method == "KNN":  # K Nearest Neighbors
+            frame = subtractor.apply(frame, learningRate=0.01)
+        _, frame = cv2.threshold(frame, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    if settings["embossToggle"]:
+        kernel = np.array([[2, 1, 0], [1, 0, -1], [0, -1, -2]])
+        frame = cv2.convertScaleAbs(cv2.filter2D(frame, -1, kernel) * settings["embossVal"])
+
+    if settings["invertToggle"]:
+        frame = cv2.bitwise_not(frame)
+
+    if settings["dilationToggle"]:
+        frame = cv2.dilate(frame, None, iterations=settings["dilateVal"])
+        kernel = np.ones((3, 3), np.uint8)
+        frame = cv2.morphologyEx(frame, cv2.MORPH_OPEN, kernel)
+
+    if settings["frameDiffToggle"]:
+        boxes, centers, boxes2D = frameDifferencing(frame, settings["frameDiffValue"], settings["frameDiffValueMax"])
+
+    return frame, boxes, centers, boxes2D
+
+class frameReader():
+    """
+    Decodes a capture on a background thread into a ring of preallocated frame buffers.
+
+    Decoding runs ahead of the consumer by up to depth frames, so it overlaps
+    with filtering (OpenCV releases the GIL in both). Once every buffer is
+    full the reader waits for the consumer to hand one back. read() mirrors
+    cap.read(), but the returned frame is a ring buffer that is reused after
+    the next read(): copy it to keep it.
+    """
+    def __init__(self, cap, depth=8):
+        self.cap = cap
+        self.buffers = [None] * depth
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for index in range(depth):
+            self.free.put(index)
+        self.current = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+        self.thread.start()
+
+    def decode(self):
+        while True:
+            index = self.free.get() # blocks while the consumer is depth frames behind
+            if self.stopped:
+                break
+            ret, frame = self.cap.read(self.buffers[index])
+            if not ret:
+                break
+            self.buffers[index] = frame # read() only reallocates on the first pass or a size change
+            self.ready.put(index)
+        self.ready.put(None)
+
+    def read(self):
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+        index = self.ready.get()
+        if index is None:
+            self.ready.put(None) # keep reporting the end
+            return False, None
+        self.current = index
+        return True, self.buffers[index]
+
+    def __iter__(self):
+        while True:
+            ret, frame = self.read()
+            if not ret:
+                return
+            yield frame
+
+    def close(self):
+        self.stopped = True
+        self.free.put(None) # wake the decoder if it is waiting for a buffer
+        self.thread.join()
+
+def portableSettings(settings):
+    """
+    Settings without the live background models, which cannot be pickled into
+    worker processes; workers build their own from subBackMethod and subBackVal.
+    """
+    return {key: value for key, value in settings.items() if key != "subBackModels"}
+
+def detectRange(file, settings, start, stop=None, warmup=0):
+    """
+    Process-pool worker for detectChunks: filter and detect frames start..stop-1
+    (to the end of the video if stop is None).
+
+    A stateful background subtractor is warm-started on the warmup frames
+    before start, which are filtered but not detected. Returns the boxes as
+    an (N, 5) float64 array and the number of boxes in each frame.
+    """
+    cap = cv2.VideoCapture(file)
+    first = max(start - warmup, 0)
+    if first > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    subtractor = createSubtractor(settings["subBackMethod"], settings.get("subBackVal", 0)) if settings["subBackToggle"] else None
+    warm_settings = dict(settings, frameDiffToggle=False)
+    parts = [np.empty((0, 5))]
+    counts = []
+    frame_index = first
+    reader = frameReader(cap)
+    try:
+        while stop is None or frame_index < stop:
+            ret, frame = reader.read()
+            if not ret:
+                break
+            if frame_index < start:
+                applyFilters(frame, warm_settings, subtractor)
+            else:
+                _, _, _, boxes2D = applyFilters(frame, settings, subtractor)
+                boxes = cleanBoxes(boxes2D)[1]
+                parts.append(boxes)
+                counts.append(len(boxes))
+            frame_index += 1
+    finally:
+        reader.close()
+        cap.release()
+    return np.concatenate(parts), np.array(counts, dtype=np.int64)
+
+def detectChunks(file, settings, writer, tracker, workers=None, chunk_size=None, warmup=None):
+    """
+    Detect one video on several cores by splitting it into frame ranges.
+
+    Every stage but background subtraction is stateless from frame to frame,
+    so each range is filtered independently in its own process. When the
+    subtractor is enabled each range starts warmup frames early (its history
+    length by default) to let the model settle, and ranges are at least warmup
+    frames long so warm-up stays a fraction of the work. Results are appended
+    to the writer and pushed to the tracker strictly in frame order, as ranges
+    finish.
+    Returns the number of frames.
+    """
+    workers = workers or threads
+    cap = cv2.VideoCapture(file)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if warmup is None:
+        warmup = 450 if settings["subBackToggle"] else 0
+    # a range shorter than its warm-up would spend most of its work re-filtering the frames before it
+    chunk_size = chunk_size or max(-(-frame_count // workers), warmup, 1)
+    starts = list(range(0, max(frame_count, 1), chunk_size))
+    frame_index = 0
+    futures = [pool.submit(detectRange, file, settings, start, start + chunk_size if k < len(starts) - 1 else None, warmup)
+               for k, start in enumerate(starts)] # the last range reads to the end, in case the frame count is an estimate
+    for future in futures:
+        boxes, counts = future.result()
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        for k in range(len(counts)):
+            frame_boxes = boxes[offsets[k]:offsets[k+1]]
+            writer.append(frame_boxes)
+            tracker.push(frame_index, frame_boxes)
+            frame_index += 1
+        print(f"Detected {frame_index}/{frame_count} frames", end='\r')
+    print()
+    return frame_index
+
+def recordVideo(file, settings, save_directory, file_format="csv", wide=False, use_cache=True, frame_workers=1, jobs=None):
+    """
+    Decode, filter, detect, track and save one video, as batch recording does
+    in processVideos but without display. With frame_workers > 1 the video is
+    split into frame ranges detected in parallel (see detectChunks). Progress
+    is recorded in jobs, a jobQueue, if given.
+    Returns (file, frame count, track count); the frame count is None when the
+    result came from the cache.
+    """
+    if jobs is not None:
+        jobs.setState(file, "recording")
+    stem = os.path.basename(file).split(".")[0]
+    os.makedirs(f"{save_directory}/contours", exist_ok=True)
+    os.makedirs(f"{save_directory}/extracted data", exist_ok=True)
+    store_path = f"{save_directory}/contours/{stem}_c.det"
+    full_filename = f'{save_directory}/contours/{stem}_c.{file_format}'
+    full_dataname = f'{save_directory}/extracted data/{stem}_ed.{"csv" if file_format == "csv" else "npz"}'
+    cache = resultCache() if use_cache else None
+    if cache is not None:
+        keys = cache.keys(file, settings)
+        tracked_objects = cache.loadResult(keys, store_path, settings["minTrackLength"])
+        if tracked_objects is not None:
+            print(f"Using cached detections for: {os.path.basename(file)}")
+            if jobs is not None:
+                jobs.setState(file, "tracking")
+            processData(store_path, full_filename, full_dataname, tracked_objects, wide=wide, file_format=file_format)
+            if jobs is not None:
+                jobs.setState(file, "done", tracks=len(tracked_objects))
+            return file, None, len(tracked_objects)
+    cap = cv2.VideoCapture(file)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video: {file}")
+    tracker = onlineTracker(min_len=settings["minTrackLength"])
+    writer = detectionWriter(store_path)
+    if frame_workers > 1:
+        cap.release()
+        try:
+            frame_index = detectChunks(file, settings, writer, tracker, workers=frame_workers)
+        except BaseException:
+            writer.discard()
+            raise
+    else:
+        subtractor = createSubtractor(settings["subBackMethod"], settings.get("subBackVal", 0)) if settings["subBackToggle"] else None
+        frame_index = 0
+        reader = frameReader(cap)
+        try:
+            for frame in reader:
+                _, _, _, boxes2D = applyFilters(frame, settings, subtractor)
+                writer.append(boxes2D)
+                tracker.push(frame_index, boxes2D)
+                frame_index += 1
+        except BaseException:
+            writer.discard()
+            raise
+        finally:
+            reader.close()
+            cap.release()
+    writer.close()
+    if jobs is not None:
+        jobs.setState(file, "tracking")
+    tracked_objects = tracker.finalize()
+    if cache is not None:
+        cache.storeResult(keys, store_path, tracked_objects)
+    processData(store_path, full_filename, full_dataname, tracked_objects, wide=wide, file_format=file_format)
+    if jobs is not None:
+        jobs.setState(file, "done", tracks=len(tracked_objects))
+    return file, frame_index, len(tracked_objects)
+
+def recordVideos(files, settings, save_directory, workers=None, file_format="csv", wide=False, callback=None, use_cache=True, jobs=None, cancel=None):
+    """
+    Record several videos at once, one per worker process.
+
+    Videos run on the shared worker pool, resized to workers if given. A
+    single video is instead split into frame ranges over the workers.
+    callback(file, result, error) is called as each video finishes, with
+    result = (file, frame count, track count) or error set to the exception.
+    Each video's state is recorded in jobs, a jobQueue, if given. Videos are
+    handed out one per free worker; once cancel (a threading.Event) is set no
+    more are started and the ones in progress finish.
+    Returns {file: result or exception} of the videos that ran.
+    """
+    files = list(files)
+    if len(files) == 0:
+        return {}
+    settings = portableSettings(settings)
+    if workers:
+        pool.setMaxWorkers(workers)
+    workers = pool.max_workers
+    results = {}
+    if len(files) == 1:
+        file = files[0]
+        print(f"Recording {os.path.basename(file)} on {workers} worker(s)")
+        try:
+            results[file] = recordVideo(file, settings, save_directory, file_format, wide, use_cache, frame_workers=workers, jobs=jobs)
+            error = None
+        except Exception as e:
+            results[file] = error = e
+            print(f"Error recording {os.path.basename(file)}: {e}")
+            if jobs is not None:
+                jobs.fail(file, e)
+        if callback is not None:
+            callback(file, None if error else results[file], error)
+        return results
+    print(f"Recording {len(files)} video(s) on {min(workers, len(files))} worker(s)")
+    t1 = time()
+    waiting = files[::-1]
+    futures = {}
+    done = 0
+    while len(waiting) > 0 or len(futures) > 0:
+        while len(waiting) > 0 and len(futures) < workers and not (cancel is not None and cancel.is_set()):
+            file = waiting.pop()
+            futures[pool.submit(recordVideo, file, settings, save_directory, file_format, wide, use_cache, jobs=jobs)] = file
+        if len(futures) == 0: # cancelled
+            break
+        finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in finished:
+            file = futures.pop(future)
+            done += 1
+            try:
+                results[file] = future.result()
+                print(f"[{done}/{len(files)}] {os.path.basename(file)}: {results[file][2]} tracks")
+                error = None
+            except Exception as e:
+                results[file] = error = e
+                print(f"[{done}/{len(files)}] Error recording {os.path.basename(file)}: {e}")
+                if jobs is not None:
+                    jobs.fail(file, e)
+            if callback is not None:
+                callback(file, None if error else results[file], error)
+    if len(waiting) > 0:
+        print(f"Cancelled, {len(waiting)} video(s) not started")
+    print(f"Recorded {done} video(s) in {time()-t1:.2f} s")
+    return results
+
+def recordBatch(files, settings, save_directory, workers=None, file_format="csv", wide=False, callback=None, use_cache=True, jobs=None, cancel=None):
+    """
+    recordVideos through the jobQueue of save_directory, so a batch can be
+    stopped or crash and be started again: videos already done with these
+    settings are skipped, interrupted ones run again, and failed ones are
+    retried until they run out of attempts. Setting cancel stops the batch
+    after the videos in progress; the rest stay pending for the next run.
+    Returns {file: result or exception} of each video's last attempt in this run.
+    """
+    jobs = jobs or jobQueue(save_directory)
+    files = list(files)
+    runnable = jobs.add(files, settings, file_format, wide)
+    if len(runnable) < len(files):
+        print(f"Skipping {len(files) - len(runnable)} video(s) already done or out of attempts (see {jobs.path})")
+    results = {}
+    try:
+        while len(runnable) > 0:
+            results.update(recordVideos(runnable, settings, save_directory, workers, file_format, wide, callback, use_cache, jobs, cancel))
+            if cancel is not None and cancel.is_set(): # the videos never started stay pending for the next run
+                jobs.requeue([file for file in runnable if file not in results])
+                break
+            runnable = jobs.runnable([file for file in runnable if isinstance(results[file], Exception)])
+            if len(runnable) > 0:
+                print(f"Retrying {len(runnable)} failed video(s)")
+    except KeyboardInterrupt: # stopped, not failed: resume these without counting an attempt
+        jobs.requeue(runnable)
+        raise
+    counts = jobs.summary(files)
+    print(", ".join(f"{count} {state}" for state, count in counts.items() if count > 0))
+    return results
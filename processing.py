@@ -0,0 +1,237 @@
+"""
+Qt-free tracking and saving, shared by the GUI and the command line tools
+"""
+import os
+import glob
+import shutil
+import threading
+from time import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+import numpy as np
+import pandas as pd
+from tracking import trackObjects, trackChunks, extractData, packTracks, unpackTracks, trackKeys
+from transport import sharedArrays, sharedHandle, receiveArrays
+from datatools import saveContours, saveData, loadContourArrays, contoursFromArrays, packContours, unpackContours, saveDetectionStore
+
+def availableCores():
+    if hasattr(os, "sched_getaffinity"): # respects taskset/cgroup CPU limits on Linux
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+threads = int(os.environ.get("NPM_WORKERS", 0)) or availableCores()
+contour_suffixes = ("_c.csv", "_c.npz", "_c.det")
+
+def workerInit():
+    cv2.setNumThreads(1) # one task per worker, OpenCV's own thread pool would oversubscribe the cores
+    pool.inline = True # the cores are already busy, nested pools would only add processes
+
+def runInline(fn, *args, **kwargs):
+    """
+    Run fn now, in this process, and return its outcome as a finished Future.
+    """
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+class workerPool():
+    """
+    Process pool shared by everything that fans work out, created on first use.
+
+    Importing this module starts no processes: workers are spawned on the first
+    submit(), reused across videos and jobs, and shut down once the pool has
+    been idle for idle_timeout seconds (the next submit starts them again).
+    The worker count defaults to the cores available to this process, or
+    NPM_WORKERS if set. Inside a worker, submit() runs the task inline.
+    """
+    def __init__(self, max_workers=None, idle_timeout=60):
+        self.max_workers = max_workers or threads
+        self.idle_timeout = idle_timeout
+        self.inline = False
+        self.reset()
+        if hasattr(os, "register_at_fork"): # a forked worker must not inherit its parent's executor
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.executor = None
+        self.active = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def setMaxWorkers(self, max_workers):
+        """
+        Resize the pool. Running tasks finish on the old workers, new ones go to a new pool.
+        """
+        with self.lock:
+            if max_workers == self.max_workers:
+                return
+            self.max_workers = max_workers
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def submit(self, fn, *args, **kwargs):
+        if self.inline:
+            return runInline(fn, *args, **kwargs)
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=workerInit)
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool: # a worker died (e.g. out of memory), its tasks failed; start over with fresh workers
+                print("Worker pool broken, restarting it")
+                self.executor.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=workerInit)
+                future = self.executor.submit(fn, *args, **kwargs)
+            self.active += 1
+        future.add_done_callback(self.taskDone)
+        return future
+
+    def taskDone(self, future):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0 and self.executor is not None and self.idle_timeout is not None:
+                self.timer = threading.Timer(self.idle_timeout, self.shutdownIdle)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def shutdownIdle(self):
+        with self.lock:
+            if self.active > 0:
+                return
+            executor, self.executor, self.timer = self.executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            executor, self.executor, self.timer = self.executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+pool = workerPool()
+
+def track(contours, chunk_size=None, min_len=30, wide=False, **tracker_options):
+    """
+    Track contours and extract the data. tracker_options (solver, predict,
+    max_gap) are passed on to the tracker. Returns (extracted data, track count).
+    """
+    t1 = time()
+    if chunk_size: # split long videos into overlapping chunks tracked on separate cores
+        tracked_objects = trackChunks(contours, chunk_size=chunk_size, min_len=min_len, executor=pool, **tracker_options)
+    else:
+        tracked_objects = trackObjects(contours, min_len=min_len, **tracker_options)
+    data = extractData(tracked_objects, wide)
+    print(f"Time elapsed: {time()-t1:.2f} s")
+    return data, len(tracked_objects)
+
+def saveExtractedData(full_dataname, extracted_data, wide=False):
+    print(f"Saving extracted data for: {full_dataname}")
+    if full_dataname.endswith(".npz"):
+        saveData(full_dataname, extracted_data)
+    else:
+        extracted_data.to_csv(full_dataname, header=True, mode='w', index=wide) # long format rows carry no meaningful index
+
+def shareTracks(tracked_objects):
+    """
+    Put finished tracks in shared memory; submit .handle as processData's
+    tracked_objects and unlink() once the job is done.
+    """
+    return sharedArrays.create(packTracks(tracked_objects))
+
+def processData(contours, full_filename, full_dataname, tracked_objects=None, min_len=30, wide=False, file_format="csv"):
+    """
+    Save contours in file_format and the extracted data of their tracks.
+
+    contours is a {frame: boxes} mapping or the path of a detection store;
+    tracked_objects is a list of tracks, the sharedHandle of shared tracks, or
+    None to track the contours here.
+    """
+    if isinstance(tracked_objects, sharedHandle):
+        tracked_objects = unpackTracks(receiveArrays(tracked_objects))
+    store_path = None
+    if isinstance(contours, str): # detection store written while recording
+        store_path = contours
+        contours = contoursFromArrays(*[np.array(array) for array in loadContourArrays(store_path)])
+    if file_format != "csv":
+        wide = False # typed binary columns only exist for the long layout
+    print(f"Saving contours for: {full_filename}")
+    if file_format == "det":
+        if store_path != full_filename:
+            saveDetectionStore(full_filename, *packContours(contours))
+    elif file_format == "npz":
+        saveContours(full_filename, contours)
+    else:
+        contours_by_frame = unpackContours(*packContours(contours)) if store_path is not None else contours
+        max_len = max((len(lst) for lst in contours_by_frame.values()), default=0)
+        dataframe = pd.DataFrame({
+            key: lst + [pd.NA] * (max_len - len(lst)) for key, lst in contours_by_frame.items()
+        })
+        dataframe.to_csv(full_filename, header=True, mode='w')
+    if store_path is not None and store_path != full_filename: # converted, the recording store is no longer needed
+        shutil.rmtree(store_path)
+    if tracked_objects is None:
+        print(f"Tracking contours for: {full_filename}")
+        extracted_data, _ = track(contours, min_len=min_len, wide=wide)
+    else: # already tracked online while the video was being processed
+        extracted_data = extractData(tracked_objects, wide)
+    saveExtractedData(full_dataname, extracted_data, wide)
+
+def contourFiles(paths):
+    """
+    Saved contour files (_c.csv, _c.npz or _c.det stores) in the given
+    directories, glob patterns or file paths, sorted and without duplicates.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path) and not path.rstrip("/\\").endswith("_c.det"):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)]
+        else:
+            candidates = glob.glob(path)
+        files.extend(os.path.normpath(f) for f in candidates if f.rstrip("/\\").endswith(contour_suffixes))
+    return sorted(set(files))
+
+def dataName(contour_file, output_directory=None, file_format="csv"):
+    """
+    Extracted data path for a contour file: <save dir>/extracted data/<name>_ed.<format>
+    next to the <save dir>/contours directory the file was saved in, unless
+    output_directory is given.
+    """
+    contour_file = os.path.normpath(contour_file)
+    name = os.path.basename(contour_file)[:-len("_c.csv")]
+    if output_directory is None:
+        output_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(contour_file))), "extracted data")
+    return os.path.join(output_directory, f"{name}_ed.{file_format}")
+
+def compareChunked(contours, chunk_size, min_len=30, **tracker_options):
+    """
+    Number of tracks that differ between chunked and single pass tracking of the same contours.
+    """
+    chunked = trackKeys(trackChunks(contours, chunk_size=chunk_size, min_len=min_len, executor=pool, **tracker_options))
+    whole = trackKeys(trackObjects(contours, min_len=min_len, **tracker_options))
+    return len(chunked ^ whole)
+
+def retrackFile(contour_file, full_dataname, min_len=30, wide=False, chunk_size=None, compare=False, **tracker_options):
+    """
+    Re-track saved contours and write the extracted data, without touching the video.
+    With compare and chunk_size, also check the chunked tracks against a single pass.
+    """
+    t1 = time()
+    contours = contoursFromArrays(*loadContourArrays(contour_file))
+    if compare and chunk_size:
+        differing = compareChunked(contours, chunk_size, min_len, **tracker_options)
+        print(f"{os.path.basename(contour_file)}: {differing} track(s) differ between chunked and single pass tracking")
+    print(f"Tracking contours for: {contour_file}")
+    extracted_data, track_count = track(contours, chunk_size=chunk_size, min_len=min_len, wide=wide, **tracker_options)
+    os.makedirs(os.path.dirname(full_dataname) or ".", exist_ok=True)
+    saveExtractedData(full_dataname, extracted_data, wide)
+    return full_dataname, track_count, time() - t1
@@ -1,62 +1,184 @@
 from npm_analyzer_light import *
 from tracking import *
-from concurrent.futures import ProcessPoolExecutor
+from datatools import loadContourArrays, contoursFromArrays
+from processing import threads, processData, shareTracks, pool
+from pipeline import recordBatch
+from collections import deque
+import threading
 """
 All Qt tools/classes for main
 """
 
-threads = os.cpu_count()
-executor = ProcessPoolExecutor(max_workers=threads)
-
-def track(contours):
-    t1 = time()
-    tracked_objects = trackObjects(contours)
-    data = extractData(tracked_objects)
-    print(f"Time elapsed: {time()-t1:.2f} s")
-    return data
-
-def processData(contours, dataframe, full_filename, full_dataname):
-    print(f"Saving contours for: {full_filename}")
-    dataframe.to_csv(full_filename, header=True, mode='w')
-    print(f"Tracking contours for: {full_filename}")
-    extracted_data = track(contours)
-    print(f"Saving extracted data for: {full_dataname}")
-    extracted_data.to_csv(full_dataname, header=True, mode='w')
-        
 class csvSaver(QObject):
-    def __init__(self, save_directory):
+    """
+    Saves and tracks finished recordings in the process pool without blocking.
+
+    save() only queues a job: up to max_in_flight jobs run at once and the rest
+    wait their turn, so the next video can be recorded while earlier ones are
+    still being tracked. job_status reports every change as (filename, status)
+    with status one of queued, running, done or failed: <error>. Videos saved
+    while a jobQueue is set (setJobQueue) are marked tracking when queued and
+    done or failed as their job finishes, here rather than through the GUI.
+    """
+    job_status = Signal(str, str)
+
+    def __init__(self, save_directory, max_in_flight=threads):
         super().__init__()
         self.save_directory = save_directory
+        self.wide = False
+        self.file_format = "csv"
         self.init_mutex = QMutex()
+        self.jobs_mutex = QMutex()
+        self.max_in_flight = max_in_flight
+        self.pending = deque()
+        self.in_flight = {}
+        self.jobs = {}
+        self.job_queue = None
+        self.closing = False
 
     def openCSV(self, directory):
-        files = [os.path.join(directory, f) for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)) and os.path.splitext(f)[-1] == ".csv"]
-        contour_data = pd.read_csv(files[0], index_col=0)
-        contours = convertFromStrings(contour_data)
+        files = [os.path.join(directory, f) for f in os.listdir(directory) if os.path.splitext(f)[-1] in (".csv", ".npz", ".det")]
+        contours = contoursFromArrays(*loadContourArrays(files[0]))
         return contours
 
     def setSaveDirectory(self, directory):
         with QMutexLocker(self.init_mutex):
             self.save_directory = directory
+
+    def setWideLayout(self, wide):
+        with QMutexLocker(self.init_mutex):
+            self.wide = wide
+
+    def setFileFormat(self, file_format):
+        with QMutexLocker(self.init_mutex):
+            self.file_format = file_format
+
+    @Slot(object)
+    def setJobQueue(self, job_queue):
+        with QMutexLocker(self.init_mutex):
+            self.job_queue = job_queue
+
+    def journal(self, job, state, error=None):
+        """
+        Record a video's state in the job queue it was saved under, if any.
+        """
+        if job is None:
+            return
+        job_queue, file = job
+        try:
+            if error is None:
+                job_queue.setState(file, state)
+            else:
+                job_queue.fail(file, error)
+        except Exception as e:
+            print(f"Could not update job queue for {os.path.basename(file)}: {e}")
+
+    def status(self):
+        with QMutexLocker(self.jobs_mutex):
+            return dict(self.jobs)
+
+    def setStatus(self, filename, status):
+        with QMutexLocker(self.jobs_mutex):
+            self.jobs[filename] = status
+        print(f'{filename.split(".")[0]}: {status}')
+        self.job_status.emit(filename, status)
         
-    @Slot(object, str)
-    def save(self, contours, filename):
+    @Slot(object, object, str, str)
+    def save(self, contours, tracked_objects, filename, file=""):
         with QMutexLocker(self.init_mutex):
             directory = self.save_directory
+            wide = self.wide
+            file_format = self.file_format
+            job = (self.job_queue, file) if self.job_queue is not None and file else None
             os.makedirs(f"{directory}/contours", exist_ok=True)
             os.makedirs(f"{directory}/extracted data", exist_ok=True)
         if contours and len(contours) > 0:
-            max_len = max(len(lst) for lst in contours.values())
-            dataframe = pd.DataFrame({
-                key: lst + [pd.NA] * (max_len - len(lst)) for key, lst in contours.items()
-            })
-            try:
-                full_filename = f'{directory}/contours/{filename.split(".")[0]}_c.csv'
-                full_dataname = f'{directory}/extracted data/{filename.split(".")[0]}_ed.csv'
-                future = executor.submit(processData, contours, dataframe, full_filename, full_dataname)
-                future.result()
-            except Exception as e:
-                print(f'Error saving {filename.split(".")[0]}: {e}')  
+            full_filename = f'{directory}/contours/{filename.split(".")[0]}_c.{file_format}'
+            full_dataname = f'{directory}/extracted data/{filename.split(".")[0]}_ed.{"csv" if file_format == "csv" else "npz"}'
+            shared = None
+            if tracked_objects is not None: # the worker maps the tracks instead of unpickling them
+                shared = shareTracks(tracked_objects)
+                tracked_objects = shared.handle
+            with QMutexLocker(self.jobs_mutex):
+                self.pending.append((filename, job, shared, (contours, full_filename, full_dataname, tracked_objects), {"wide": wide, "file_format": file_format}))
+            self.journal(job, "tracking")
+            self.setStatus(filename, "queued")
+            self.submitPending()
+
+    def submitPending(self):
+        """
+        Move queued jobs into the pool while fewer than max_in_flight are running.
+        """
+        while True:
+            with QMutexLocker(self.jobs_mutex):
+                if len(self.pending) == 0 or (len(self.in_flight) >= self.max_in_flight and not self.closing):
+                    return
+                filename, job, shared, args, kwargs = self.pending.popleft()
+                try:
+                    future = pool.submit(processData, *args, **kwargs)
+                except Exception as e:
+                    future = None
+                    error = e
+                else:
+                    self.in_flight[future] = shared
+            if future is None:
+                if shared is not None:
+                    shared.unlink()
+                self.journal(job, "failed", error)
+                self.setStatus(filename, f"failed: {error}")
+                continue
+            self.setStatus(filename, "running")
+            future.add_done_callback(lambda future, filename=filename, job=job: self.jobDone(filename, future, job))
+
+    def jobDone(self, filename, future, job=None):
+        """
+        Completion callback, called from the pool's result thread.
+        """
+        with QMutexLocker(self.jobs_mutex):
+            shared = self.in_flight.pop(future, None)
+        if shared is not None:
+            shared.unlink()
+        try:
+            future.result()
+        except Exception as e:
+            self.journal(job, "failed", e)
+            self.setStatus(filename, f"failed: {e}")
+        else:
+            self.journal(job, "done")
+            self.setStatus(filename, "done")
+        self.submitPending()
 
     def closeThreads(self):
-        executor.shutdown(wait=True)
+        with QMutexLocker(self.jobs_mutex):
+            self.closing = True
+        self.submitPending() # nothing queued is dropped on exit
+        pool.shutdown(wait=True)
+
+class batchRecorder(QObject):
+    """
+    Runs pipeline.recordBatch off the GUI thread, reporting each video as it finishes.
+    stop() is called directly from the GUI thread, since this thread is busy in record().
+    """
+    video_done = Signal(str, str)
+    batch_finished = Signal()
+
+    def __init__(self):
+        super().__init__()
+        self.cancel = threading.Event()
+
+    def stop(self):
+        """
+        Start no more videos; the ones in progress finish and the rest stay queued.
+        """
+        self.cancel.set()
+
+    @Slot(list, dict, str, str, bool, int)
+    def record(self, files, settings, directory, file_format, wide, workers):
+        def report(file, result, error):
+            self.video_done.emit(file, "done" if error is None else f"failed: {error}")
+        try:
+            self.cancel.clear()
+            recordBatch(files, settings, directory, workers=workers, file_format=file_format, wide=wide, callback=report, cancel=self.cancel)
+        except Exception as e:
+            print(f"Error during batch recording: {e}")
+        self.batch_finished.emit()
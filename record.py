@@ -0,0 +1,46 @@
+"""
+Batch record videos without the GUI: decode, filter, detect, track and save
+
+    python record.py "D:/runs/videos" --settings settings.json -o "D:/runs" -j 8
+
+Progress is journaled in <save directory>/jobs.sqlite: running the same
+command again after a crash skips the videos that are already done.
+"""
+import os
+import argparse
+from pipeline import loadSettings, default_settings, videoFiles, recordBatch
+from jobqueue import jobQueue
+from processing import threads
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Batch record videos headlessly with the settings saved from the GUI.")
+    parser.add_argument("paths", nargs="+", help="video files, directories or glob patterns")
+    parser.add_argument("-s", "--settings", default=None, help="settings JSON (Tools > Save Settings); defaults to frame differencing only")
+    parser.add_argument("-o", "--output", default=os.getcwd(), help="save directory; contours/ and extracted data/ are created in it")
+    parser.add_argument("--format", choices=("csv", "npz", "det"), default="csv", help="save format")
+    parser.add_argument("--wide", action="store_true", help="legacy wide csv layout")
+    parser.add_argument("-j", "--workers", type=int, default=threads, help="worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="ignore and do not update the result cache")
+    parser.add_argument("--max-attempts", type=int, default=3, help="give up on a video after this many failed or interrupted runs")
+    parser.add_argument("--retry-failed", action="store_true", help="give videos that ran out of attempts another round")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+    settings = loadSettings(args.settings) if args.settings else dict(default_settings)
+    files = videoFiles(args.paths)
+    if len(files) == 0:
+        raise SystemExit("No video files found")
+    jobs = jobQueue(args.output, max_attempts=args.max_attempts)
+    if args.retry_failed:
+        jobs.retryFailed()
+    recordBatch(files, settings, args.output, workers=args.workers, file_format=args.format,
+                wide=args.wide, use_cache=not args.no_cache, jobs=jobs)
+    keys = {jobs.jobKey(file) for file in files}
+    failed = [os.path.basename(file) for file, job in jobs.jobs().items() if file in keys and job["state"] == "failed"]
+    if failed:
+        print(f"{len(failed)} video(s) failed: {', '.join(failed)} (rerun with --retry-failed once fixed)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
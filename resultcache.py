@@ -0,0 +1,166 @@
+"""
+Content-addressed cache of detections and tracks, keyed by video fingerprint and settings
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from tracking import trackObjects, packTracks, unpackTracks
+from datatools import detectionStore
+
+# settings that change what is detected; display toggles and the stateful background models are left out
+detection_keys = ("adaptToggle", "adaptMethod", "adaptArea", "adaptValueC", "autoToggle", "invertToggle",
+                  "thresholdToggle", "thresholdVal", "embossToggle", "embossVal", "blurToggle", "blurVal",
+                  "dilationToggle", "dilateVal", "subBackToggle", "subBackMethod", "subBackVal", "frameDiffToggle",
+                  "frameDiffValue", "frameDiffValueMax")
+tracking_keys = ("minTrackLength",)
+
+def videoFingerprint(file, block_size=1 << 20):
+    """
+    Hash of a video's size and its first, middle and last block_size bytes.
+
+    Reading three blocks keeps this instant for multi-GB videos while still
+    telling apart re-encoded or truncated copies of the same file name.
+    """
+    size = os.path.getsize(file)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file, "rb") as f:
+        for position in sorted({0, max(size // 2 - block_size // 2, 0), max(size - block_size, 0)}):
+            f.seek(position)
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+def settingsHash(settings, keys):
+    """
+    Hash of the canonical JSON of the given settings keys.
+    """
+    canonical = json.dumps({key: settings.get(key) for key in keys}, sort_keys=True, default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+def entrySize(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+class resultCache():
+    """
+    Directory of cached detection stores (<key>.det) and finalized tracks
+    (<key>.tracks, the packTracks columns as an .npz archive).
+
+    Detections are keyed by video fingerprint + detection settings, tracks by the
+    detection key + tracking settings, so changing the minimum track length
+    re-tracks cached detections without decoding the video again. Entries are
+    written under a temporary name and renamed into place, so a crash never
+    leaves a partial entry behind. Once the directory grows past max_bytes the
+    least recently used entries are evicted.
+    """
+    def __init__(self, directory=None, max_bytes=20 * 1024**3):
+        self.directory = directory or os.path.join(os.path.expanduser("~"), ".npm_analyzer_light", "cache")
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def keys(self, file, settings):
+        """
+        (detection key, track key) for a video processed with settings.
+        """
+        detection_key = f"{videoFingerprint(file)}-{settingsHash(settings, detection_keys)}"
+        return detection_key, f"{detection_key}-{settingsHash(settings, tracking_keys)}"
+
+    def entryPath(self, key, kind):
+        return os.path.join(self.directory, f"{key}.{kind}")
+
+    def lookup(self, key, kind):
+        path = self.entryPath(key, kind)
+        if not os.path.exists(path):
+            return None
+        os.utime(path) # mark as recently used for eviction
+        return path
+
+    def lookupDetections(self, key, destination):
+        """
+        Copy cached detections to the destination store path. Returns False on a miss.
+        """
+        path = self.lookup(key, "det")
+        if path is None:
+            return False
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        shutil.copytree(path, destination)
+        return True
+
+    def lookupTracks(self, key):
+        path = self.lookup(key, "tracks")
+        if path is None:
+            return None
+        try:
+            with np.load(path) as data:
+                return unpackTracks({name: data[name] for name in data.files})
+        except (OSError, ValueError, KeyError) as e: # unreadable, or pickled by an older version: re-track
+            print(f"Ignoring cached tracks {os.path.basename(path)}: {e}")
+            return None
+
+    def storeDetections(self, key, store_path):
+        path = self.entryPath(key, "det")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        shutil.copytree(store_path, temporary, dirs_exist_ok=True)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(temporary, path)
+        self.evict()
+
+    def storeTracks(self, key, tracked_objects):
+        path = self.entryPath(key, "tracks")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f: # filled rows only, not the store's spare capacity
+            np.savez(f, **packTracks(tracked_objects))
+        os.replace(temporary, path)
+        self.evict()
+
+    def loadResult(self, keys, store_path, min_len):
+        """
+        Restore cached detections to store_path and return their tracks, re-tracking
+        them if only the tracking settings changed. Returns None on a miss.
+        """
+        detection_key, track_key = keys
+        if not self.lookupDetections(detection_key, store_path):
+            return None
+        tracked_objects = self.lookupTracks(track_key)
+        if tracked_objects is None:
+            tracked_objects = trackObjects(detectionStore(store_path), min_len=min_len)
+            self.storeTracks(track_key, tracked_objects)
+        return tracked_objects
+
+    def storeResult(self, keys, store_path, tracked_objects):
+        detection_key, track_key = keys
+        try:
+            self.storeDetections(detection_key, store_path)
+            if tracked_objects is not None:
+                self.storeTracks(track_key, tracked_objects)
+        except OSError as e:
+            print(f"Could not cache results for {store_path}: {e}")
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                continue
+            entries.append((os.path.getmtime(path), entrySize(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f"Evicting cached result: {os.path.basename(path)}")
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
@@ -0,0 +1,60 @@
+"""
+Re-track saved contour files without the GUI or the videos
+
+    python retrack.py "D:/runs/contours" --min-len 50 --solver optimal --max-gap 3
+"""
+import os
+import argparse
+from time import time
+from concurrent.futures import as_completed
+from processing import threads, pool, runInline, contourFiles, dataName, retrackFile
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Re-track saved contours (_c.csv, _c.npz, _c.det) and write extracted data.")
+    parser.add_argument("paths", nargs="+", help="contour files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default=None, help="directory for extracted data (default: 'extracted data' next to each contours directory)")
+    parser.add_argument("--format", choices=("csv", "npz"), default="csv", help="extracted data format")
+    parser.add_argument("--wide", action="store_true", help="legacy wide csv layout")
+    parser.add_argument("--min-len", type=int, default=30, help="discard tracks shorter than this many frames")
+    parser.add_argument("--solver", choices=("greedy", "optimal"), default="greedy")
+    parser.add_argument("--predict", action="store_true", help="match against constant velocity predictions")
+    parser.add_argument("--max-gap", type=int, default=0, help="frames a lost track may be relinked across")
+    parser.add_argument("--chunk-size", type=int, default=None, help="also split each file into chunks of this many frames")
+    parser.add_argument("--compare", action="store_true", help="with --chunk-size, report tracks that differ from a single pass")
+    parser.add_argument("-j", "--workers", type=int, default=threads, help="files tracked at once")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+    if args.wide and args.format != "csv":
+        raise SystemExit("--wide only applies to the csv format")
+    files = contourFiles(args.paths)
+    if len(files) == 0:
+        raise SystemExit("No contour files found")
+    tracker_options = {"solver": args.solver, "predict": args.predict, "max_gap": args.max_gap}
+    jobs = [(f, (f, dataName(f, args.output, args.format), args.min_len, args.wide, args.chunk_size, args.compare)) for f in files]
+    t1 = time()
+    failed = 0
+    if args.chunk_size: # files one at a time, each split into chunks over all workers (in a worker they would run inline)
+        print(f"Re-tracking {len(files)} file(s) in chunks on {args.workers} worker(s)")
+        pool.setMaxWorkers(args.workers)
+        finished = ((f, runInline(retrackFile, *arguments, **tracker_options)) for f, arguments in jobs)
+    else:
+        print(f"Re-tracking {len(files)} file(s) on {min(args.workers, len(files))} worker(s)")
+        pool.setMaxWorkers(min(args.workers, len(files)))
+        futures = {pool.submit(retrackFile, *arguments, **tracker_options): f for f, arguments in jobs}
+        finished = ((futures[future], future) for future in as_completed(futures))
+    for done, (f, future) in enumerate(finished, 1):
+        name = os.path.basename(f)
+        try:
+            full_dataname, track_count, elapsed = future.result()
+            print(f"[{done}/{len(files)}] {name}: {track_count} tracks in {elapsed:.2f} s -> {full_dataname}")
+        except Exception as e:
+            failed += 1
+            print(f"[{done}/{len(files)}] Error re-tracking {name}: {e}")
+    pool.shutdown(wait=True)
+    print(f"Finished {len(files) - failed}/{len(files)} file(s) in {time()-t1:.2f} s")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
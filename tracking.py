@@ -1,142 +1,742 @@
-import ast
 import numpy as np
 from collections import defaultdict
 from time import time
 import os
 import pandas as pd
-import cv2
-
-def convertFromStrings(contours: dict):
-    print("Converting strings to Python types...")
-    contours_fixed = {}
-    for frame_index in contours:
-        boxes2D = contour_data[frame_index]
-        new_boxes2D = []
-        for box2D in boxes2D:
-            try:
-                new_boxes2D.append(ast.literal_eval(box2D))
-            except Exception as e:
-                if "nan" in str(e):
-                    new_boxes2D.append(np.nan)
-                else:
-                    print("Error parsing .csv")
-        contours_fixed[int(frame_index)] = new_boxes2D
-    df_contours = pd.DataFrame(contours_fixed)
-    return df_contours
+from concurrent.futures import ProcessPoolExecutor
+from transport import sharedArrays
+
+class trackStore():
+    """
+    Struct-of-arrays buffers holding every tracked detection, one row per detection.
+
+    Rows are appended a frame at a time and the buffers grow by doubling, so a
+    detection costs one row across the columns instead of per-frame dicts and
+    small numpy arrays on a Python object.
+    """
+    int_columns = ("track", "frame", "slot")
+    float_columns = ("cx", "cy", "w", "h", "angle", "vx", "vy", "area")
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.capacity = capacity
+        self.index = None # (rows sorted by track then frame, their tracks), rebuilt lazily after any change
+        for name in self.int_columns:
+            setattr(self, name, np.empty(capacity, dtype=np.int64))
+        for name in self.float_columns:
+            setattr(self, name, np.empty(capacity, dtype=np.float64))
+
+    def reserve(self, extra):
+        needed = self.size + extra
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, 2 * self.capacity)
+        for name in self.int_columns + self.float_columns:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def extend(self, track, frame, slot, boxes, velocities):
+        """
+        Append one row per box. boxes is an (N, 5) array of [cx, cy, w, h, angle]
+        and velocities an (N, 2) array; track, frame and slot broadcast.
+        """
+        n = len(boxes)
+        if n == 0:
+            return
+        self.reserve(n)
+        rows = slice(self.size, self.size + n)
+        self.track[rows] = track
+        self.frame[rows] = frame
+        self.slot[rows] = slot
+        self.cx[rows], self.cy[rows] = boxes[:, 0], boxes[:, 1]
+        self.w[rows], self.h[rows] = boxes[:, 2], boxes[:, 3]
+        self.angle[rows] = boxes[:, 4]
+        self.vx[rows], self.vy[rows] = velocities[:, 0], velocities[:, 1]
+        self.area[rows] = boxes[:, 2] * boxes[:, 3]
+        self.size += n
+        self.index = None
+
+    def column(self, name):
+        return getattr(self, name)[:self.size]
+
+    def discard(self, identities):
+        """
+        Drop every row of the given tracks, compacting the buffers in place.
+        """
+        keep = ~np.isin(self.column("track"), np.asarray(identities, dtype=np.int64))
+        size = int(np.count_nonzero(keep))
+        for name in self.int_columns + self.float_columns:
+            column = getattr(self, name)
+            column[:size] = column[:self.size][keep]
+        self.size = size
+        self.index = None
+
+    def trackIndex(self):
+        """
+        Rows sorted by track and then frame, with the track of each, so the rows
+        of any track are one contiguous slice found by binary search.
+        """
+        if self.index is None:
+            tracks = self.column("track")
+            order = np.lexsort((self.column("frame"), tracks))
+            self.index = (order, tracks[order])
+        return self.index
+
+    def rowsOf(self, identities):
+        """
+        Rows belonging to the given tracks, ordered by frame and then by the
+        position of their track in identities.
+        """
+        identities = np.asarray(identities, dtype=np.int64).reshape(-1)
+        order, sorted_tracks = self.trackIndex()
+        starts = np.searchsorted(sorted_tracks, identities, side='left')
+        lengths = np.searchsorted(sorted_tracks, identities, side='right') - starts
+        if len(identities) == 1: # already in frame order
+            return order[starts[0]:starts[0] + lengths[0]]
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(int(lengths.sum())) + np.repeat(starts - offsets, lengths)
+        rows = order[positions]
+        rank = np.repeat(np.arange(len(identities)), lengths)
+        return rows[np.lexsort((rank, self.column("frame")[rows]))]
 
 class detectedObject():
-    def __init__(self, identity, new_box, closest_box, frame_index, velocities, area_new, area_closest, centers):
+    """
+    Handle on one track. The detections themselves live in a shared trackStore.
+    """
+    __slots__ = ("identity", "store", "length")
+
+    def __init__(self, identity, store, length=0):
         self.identity = identity
-        self.box2D = {}
-        self.frames_in = []
-        self.velocities = {}
-        self.areas = {}
-        self.positions = {}
-        self.addDetection(closest_box, frame_index-1, velocities, area_new, centers[0])
-        self.addDetection(new_box, frame_index, velocities, area_closest, centers[1])
-        
-    def addDetection(self, box2D, frame, velocities, area, center):
-        self.box2D[frame]=box2D
-        self.velocities[frame] = velocities
-        self.areas[frame] = area
-        self.positions[frame] = center
-        self.frames_in.append(frame)
-
-def trackObjects(contours, min_len=30):
-    object_id = 0
-    tracked_objects, filtered_objects = {}, []
-    prev_objects = []
-    temp_objects = []
-    
-    for frame_index in range(1, len(contours.keys())):
-        new_boxes2D = contours[frame_index]
-        old_boxes2D = contours[frame_index-1]
-        old_centers = []
-        old_boxes2D_clean = []
-        for old_box2D in old_boxes2D:
-            if not isinstance(old_box2D, float) and np.array(old_box2D[0]).shape == (2,):
-                old_centers.append(old_box2D[0])
-                old_boxes2D_clean.append(old_box2D)
-
-        old_boxes2D = old_boxes2D_clean
-        for new_box2D in new_boxes2D:
-            if not isinstance(new_box2D, float):
-                if np.shape(old_centers) == (0,):
-                    break
-                exists=False
-                distances = np.sum((np.array(old_centers) - new_box2D[0]) ** 2, axis=1)
-                closest_box = old_boxes2D[np.argmin(distances)]
-    
-                threshold = np.max(np.concatenate((new_box2D[1], closest_box[1])))**2
-                distance = np.linalg.norm(np.asarray(new_box2D[0]) - np.asarray(closest_box[0]))
-                if distance < threshold:
-                    result, _ = cv2.rotatedRectangleIntersection(new_box2D, closest_box) # check if overlapping
+        self.store = store
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def rows(self):
+        return self.store.rowsOf([self.identity])
+
+    @property
+    def frames_in(self):
+        return self.store.column("frame")[self.rows()].tolist()
+
+def trackColumns(store):
+    """
+    Copies of a trackStore's filled columns, e.g. to send to another process.
+    """
+    return {name: store.column(name).copy() for name in store.int_columns + store.float_columns}
+
+def storeFromColumns(columns):
+    store = trackStore(capacity=max(len(columns["track"]), 1))
+    for name, column in columns.items():
+        getattr(store, name)[:len(column)] = column
+    store.size = len(columns["track"])
+    store.index = None
+    return store
+
+def packTracks(tracked_objects):
+    """
+    Tracks as flat arrays: the store columns plus the identity and length of
+    each track in order. Inverse of unpackTracks.
+    """
+    if len(tracked_objects) == 0:
+        columns = trackColumns(trackStore(capacity=1))
+    else:
+        columns = trackColumns(tracked_objects[0].store)
+    columns["identity"] = np.array([tracked_object.identity for tracked_object in tracked_objects], dtype=np.int64)
+    columns["length"] = np.array([tracked_object.length for tracked_object in tracked_objects], dtype=np.int64)
+    return columns
+
+def unpackTracks(columns):
+    identities, lengths = columns.pop("identity"), columns.pop("length")
+    store = storeFromColumns(columns)
+    return [detectedObject(identity, store, length) for identity, length in zip(identities.tolist(), lengths.tolist())]
+
+def trackKeys(tracked_objects):
+    """
+    Each track as the frozenset of its (frame, slot) detections, to compare the
+    tracks of two runs independently of their identities.
+    """
+    stores = {}
+    for tracked_object in tracked_objects:
+        stores.setdefault(id(tracked_object.store), (tracked_object.store, []))[1].append(tracked_object.identity)
+    keys = set()
+    for store, identities in stores.values():
+        order, tracks = store.trackIndex() # one sort by track, instead of a scan of the store per track
+        kept = np.isin(tracks, identities)
+        order, tracks = order[kept], tracks[kept]
+        bounds = np.flatnonzero(np.diff(tracks)) + 1
+        frames = np.split(store.column("frame")[order], bounds)
+        slots = np.split(store.column("slot")[order], bounds)
+        keys.update(frozenset(zip(f.tolist(), s.tolist())) for f, s in zip(frames, slots) if len(f) > 0)
+    return keys
+
+class gridIndex():
+    """
+    Uniform grid hash over a set of 2D points, built once per frame.
+
+    Points are bucketed into square cells of side cell_size and the packed cell
+    keys are kept sorted, so every cell lookup is a binary search instead of a
+    scan over all points.
+    """
+    def __init__(self, points, cell_size):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size) if cell_size > 0 else 1.0
+        cells = np.floor(self.points / self.cell_size).astype(np.int64)
+        keys = self.cellKeys(cells[:, 0], cells[:, 1])
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    @staticmethod
+    def cellKeys(cx, cy):
+        return (cx << 32) | (cy & 0xFFFFFFFF)
+
+    def queryPairs(self, points, radii):
+        """
+        Find every indexed point within radii[i] of points[i].
+
+        Returns (query index, point index, distance) arrays sorted by query index
+        and then by distance, so the first entry of each query is its nearest neighbour.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(points),))
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+        if len(points) == 0 or len(self.keys) == 0:
+            return empty
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        reach = int(np.ceil(np.max(radii) / self.cell_size))
+        query_idx, point_idx = [], []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                keys = self.cellKeys(cells[:, 0] + dx, cells[:, 1] + dy)
+                lo = np.searchsorted(self.keys, keys, side='left')
+                hi = np.searchsorted(self.keys, keys, side='right')
+                counts = hi - lo
+                total = counts.sum()
+                if total == 0:
+                    continue
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                query_idx.append(np.repeat(np.arange(len(points)), counts))
+                point_idx.append(self.order[np.repeat(lo, counts) + offsets])
+        if len(query_idx) == 0:
+            return empty
+        query_idx = np.concatenate(query_idx)
+        point_idx = np.concatenate(point_idx)
+        distances = np.linalg.norm(points[query_idx] - self.points[point_idx], axis=1)
+        keep = distances < radii[query_idx]
+        query_idx, point_idx, distances = query_idx[keep], point_idx[keep], distances[keep]
+        order = np.lexsort((distances, query_idx))
+        return query_idx[order], point_idx[order], distances[order]
+
+def cleanBoxes(boxes2D):
+    """
+    Drop padding (NaN) and malformed entries from a frame's box2D list.
+
+    Returns the valid box2D tuples and an (N, 5) array of [cx, cy, w, h, angle].
+    An (N, 5) array, as stored by datatools, is passed through without tuples.
+    """
+    if isinstance(boxes2D, np.ndarray):
+        return [], boxes2D.astype(np.float64).reshape(-1, 5)
+    clean = []
+    for box2D in boxes2D:
+        if not isinstance(box2D, float) and np.array(box2D[0]).shape == (2,):
+            clean.append(box2D)
+    if len(clean) == 0:
+        return clean, np.empty((0, 5))
+    array = np.array([(box2D[0][0], box2D[0][1], box2D[1][0], box2D[1][1], box2D[2]) for box2D in clean], dtype=np.float64)
+    return clean, array
+
+def candidatePairs(old_array, new_array):
+    """
+    Candidate (new, old) box pairs, grouped by new box and nearest first.
+
+    Two rotated rectangles can only overlap when their centers are closer than
+    the sum of their half diagonals, so the search radius of each new box is
+    bounded by its own half diagonal plus the largest old half diagonal. Anything
+    further away can never pass the overlap test and is never returned.
+    """
+    old_diagonals = np.hypot(old_array[:, 2], old_array[:, 3])
+    new_diagonals = np.hypot(new_array[:, 2], new_array[:, 3])
+    radii = (new_diagonals + np.max(old_diagonals)) / 2
+    grid = gridIndex(old_array[:, :2], max(np.max(old_diagonals), np.max(new_diagonals)))
+    return grid.queryPairs(new_array[:, :2], radii)
+
+def rotatedOverlap(boxes_a, boxes_b):
+    """
+    Batched overlap test for pairs of rotated rectangles, the vectorized
+    equivalent of cv2.rotatedRectangleIntersection(a, b)[0] > 0.
+
+    boxes_a[i] is tested against boxes_b[i], both (N, 5) arrays of
+    [cx, cy, w, h, angle]. Pairs whose bounding circles are apart are rejected
+    first; the rest go through a separating axis test on the four edge normals.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 5)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 5)
+    offsets = boxes_b[:, :2] - boxes_a[:, :2]
+    reach = (np.hypot(boxes_a[:, 2], boxes_a[:, 3]) + np.hypot(boxes_b[:, 2], boxes_b[:, 3])) / 2
+    overlap = np.hypot(offsets[:, 0], offsets[:, 1]) <= reach
+    pairs = np.flatnonzero(overlap)
+    if len(pairs) == 0:
+        return overlap
+
+    a, b, offsets = boxes_a[pairs], boxes_b[pairs], offsets[pairs]
+    angle_a, angle_b = np.radians(a[:, 4]), np.radians(b[:, 4])
+    u_a = np.column_stack((np.cos(angle_a), np.sin(angle_a))) # width direction
+    v_a = np.column_stack((-np.sin(angle_a), np.cos(angle_a))) # height direction
+    u_b = np.column_stack((np.cos(angle_b), np.sin(angle_b)))
+    v_b = np.column_stack((-np.sin(angle_b), np.cos(angle_b)))
+    separated = np.zeros(len(pairs), dtype=bool)
+    for axis in (u_a, v_a, u_b, v_b):
+        radius_a = a[:, 2] / 2 * np.abs(np.sum(u_a * axis, axis=1)) + a[:, 3] / 2 * np.abs(np.sum(v_a * axis, axis=1))
+        radius_b = b[:, 2] / 2 * np.abs(np.sum(u_b * axis, axis=1)) + b[:, 3] / 2 * np.abs(np.sum(v_b * axis, axis=1))
+        separated |= np.abs(np.sum(offsets * axis, axis=1)) > radius_a + radius_b
+    overlap[pairs] = ~separated
+    return overlap
+
+def gatePairs(old_array, new_array, new_idx, old_idx, distances):
+    """
+    Apply the tracking gate to candidate pairs: center distance below the squared
+    largest side of either box, and the two rotated rectangles must overlap.
+    """
+    sides = np.maximum(np.max(new_array[new_idx, 2:4], axis=1), np.max(old_array[old_idx, 2:4], axis=1))
+    keep = distances < sides**2
+    keep[keep] = rotatedOverlap(new_array[new_idx[keep]], old_array[old_idx[keep]])
+    return keep
+
+def optimalMatches(old_array, new_array):
+    """
+    Globally optimal one-to-one matching between two frames.
+
+    Gated candidate pairs form a sparse bipartite graph. Each connected component
+    is an independent assignment problem: components made of a single pair are
+    matched directly, larger ones are solved with a linear sum assignment that
+    minimizes the total center distance.
+
+    Returns (new index, old index) arrays sorted by new index.
+    """
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    new_idx, old_idx, distances = candidatePairs(old_array, new_array)
+    keep = gatePairs(old_array, new_array, new_idx, old_idx, distances)
+    new_idx, old_idx, distances = new_idx[keep], old_idx[keep], distances[keep]
+    if len(new_idx) == 0:
+        return new_idx, old_idx
+
+    n_new, n_old = len(new_array), len(old_array)
+    graph = coo_matrix((np.ones(len(new_idx)), (new_idx, n_new + old_idx)), shape=(n_new + n_old, n_new + n_old))
+    _, labels = connected_components(graph, directed=False)
+    components = labels[new_idx]
+    edges_per_component = np.bincount(components)
+
+    single = edges_per_component[components] == 1
+    matched_new, matched_old = [new_idx[single]], [old_idx[single]]
+
+    shared = np.flatnonzero(~single)
+    shared = shared[np.argsort(components[shared], kind='stable')]
+    bounds = np.flatnonzero(np.diff(components[shared])) + 1
+    for edges in np.split(shared, bounds):
+        if len(edges) == 0:
+            continue
+        rows, row_of = np.unique(new_idx[edges], return_inverse=True)
+        cols, col_of = np.unique(old_idx[edges], return_inverse=True)
+        no_edge = distances[edges].max() * (len(rows) + len(cols)) + 1
+        cost = np.full((len(rows), len(cols)), no_edge)
+        cost[row_of, col_of] = distances[edges]
+        r, c = linear_sum_assignment(cost)
+        real = cost[r, c] < no_edge
+        matched_new.append(rows[r[real]])
+        matched_old.append(cols[c[real]])
+
+    matched_new, matched_old = np.concatenate(matched_new), np.concatenate(matched_old)
+    order = np.argsort(matched_new, kind='stable')
+    return matched_new[order], matched_old[order]
+
+def greedyMatches(old_array, new_array, owned):
+    """
+    Match every new box, in detection order, to its nearest remaining old box if
+    the pair passes the gate. An old box is only removed from the remaining set
+    when it extends an existing track (owned[old index] is True).
+
+    Returns (new index, old index) arrays.
+    """
+    candidates, old_idx, distances = candidatePairs(old_array, new_array)
+    gated = gatePairs(old_array, new_array, candidates, old_idx, distances) # one batched overlap test per frame
+    starts = np.searchsorted(candidates, np.arange(len(new_array)), side='left').tolist()
+    ends = np.searchsorted(candidates, np.arange(len(new_array)), side='right').tolist()
+    old_idx, gated = old_idx.tolist(), gated.tolist()
+    taken = np.zeros(len(old_array), dtype=bool)
+    remaining = len(old_array)
+    matched_new, matched_old = [], []
+    for new_index in range(len(new_array)):
+        if remaining == 0:
+            break
+        for k in range(starts[new_index], ends[new_index]):
+            closest_index = old_idx[k]
+            if not taken[closest_index]: # nearest remaining box; anything beyond the candidates is too far to overlap
+                if gated[k]:
+                    matched_new.append(new_index)
+                    matched_old.append(closest_index)
+                    if owned[closest_index]:
+                        taken[closest_index] = True
+                        remaining -= 1
+                break
+    return np.array(matched_new, dtype=np.int64), np.array(matched_old, dtype=np.int64)
+
+class onlineTracker():
+    """
+    Incremental tracker: push() one frame of box2D detections at a time, as they
+    are detected, and collect the tracks with finalize().
+
+    Only the previous frame's boxes and the tracks ending there are kept between
+    pushes. solver="greedy" matches every new box to its nearest remaining old
+    box in detection order. solver="optimal" solves a gated one-to-one assignment
+    per frame pair instead (requires scipy).
+
+    With predict=True, the box at the end of each active track is moved forward
+    by the track's last velocity (constant-velocity model) before candidates are
+    searched and gated. Fast particles then still overlap their prediction, and
+    the search radius around it stays at the box size instead of the distance
+    travelled.
+
+    With max_gap > 0, a track that is not extended is kept in a small lost-track
+    buffer for up to max_gap missing frames. Detections left unmatched in later
+    frames are relinked to it through the same gated candidate search, around
+    its position extrapolated over the gap.
+
+    Tracks that end with fewer than min_len detections are released as soon as
+    they end, and their rows are compacted out of the store in batches.
+    """
+    def __init__(self, min_len=30, solver="greedy", predict=False, max_gap=0):
+        if solver not in ("greedy", "optimal"):
+            raise ValueError(f"Unknown solver: {solver}")
+        self.min_len = min_len
+        self.released, self.released_rows = [], 0
+        self.solver = solver
+        self.predict = predict
+        self.max_gap = max_gap
+        self.lost = {} # track -> (last frame, last box, last velocity) for tracks that may still be relinked
+        self.store = trackStore()
+        self.object_id = 0
+        self.tracked_objects = {}
+        self.prev_owners = {} # detection slot in the previous frame -> track that ends there
+        self.prev_frame = None
+        self.old_array = np.empty((0, 5))
+        self.old_velocities = np.empty((0, 2)) # velocity of the track ending at each previous slot, NaN if none
+
+    def push(self, frame_index, boxes2D):
+        _, new_array = cleanBoxes(boxes2D)
+        old_array = self.old_array
+        owners = {} # detection slot in this frame -> track extended or started there
+        consecutive = self.prev_frame is not None and frame_index == self.prev_frame + 1
+        new_velocities = np.full((len(new_array), 2), np.nan)
+        if consecutive and len(old_array) > 0 and len(new_array) > 0:
+            search_array = old_array
+            if self.predict:
+                search_array = old_array.copy()
+                moving = ~np.isnan(self.old_velocities[:, 0])
+                search_array[moving, :2] -= self.old_velocities[moving] # velocities are stored as old - new
+            if self.solver == "optimal":
+                new_idx, old_idx = optimalMatches(search_array, new_array)
+            else:
+                owned = np.zeros(len(old_array), dtype=bool)
+                owned[list(self.prev_owners.keys())] = True
+                new_idx, old_idx = greedyMatches(search_array, new_array, owned)
+
+            seeded = np.zeros(len(new_idx), dtype=bool)
+            identities = np.empty(len(new_idx), dtype=np.int64)
+            for k, (new_index, old_index) in enumerate(zip(new_idx.tolist(), old_idx.tolist())):
+                tracked_object = self.prev_owners.pop(old_index, None)
+                if tracked_object is not None:
+                    #print(f"Found match with {tracked_object.identity}", end='\r')
+                    self.tracked_objects[tracked_object] = None
                 else:
-                    result = 0
-    
-                if result > 0:
-                    centers = np.array([new_box2D[0],closest_box[0]])   
-                    velocities = np.diff(centers, axis=0)[0]
-                    area = np.prod(new_box2D[1])
-                    if len(tracked_objects) == 0:
-                        print("Initializing first object-match pair")
-                        new_object = detectedObject(object_id, new_box2D, closest_box, frame_index, velocities, area, np.prod(closest_box[1]), centers)
-                        tracked_objects[new_object]=None
-                        prev_objects.append(new_object)
-                        object_id += 1
-                        continue
-                    for tracked_object in prev_objects:
-                        if (frame_index - 1) in tracked_object.box2D and tracked_object.box2D[frame_index-1] == closest_box:
-                            #print(f"Found match with {tracked_object.identity}", end='\r')
-                            tracked_object.addDetection(new_box2D, frame_index, velocities, area, centers[0])
-                            prev_objects.remove(tracked_object)
-                            temp_objects.append(tracked_object)
-                            tracked_objects[tracked_object] = None
-                            old_boxes2D.remove(closest_box)
-                            old_centers.remove(closest_box[0])
-                            exists=True
-                            break
-                    if not exists:
-                        #print(f"Adding new object {object_id}", end='\r')
-                        new_object = detectedObject(object_id, new_box2D, closest_box, frame_index, velocities, area, np.prod(closest_box[1]), centers)
-                        temp_objects.append(new_object)
-                        object_id += 1
-        print(f"Total objects found: {object_id} ({frame_index/(len(contours.keys())-1)*100:.2f}%)", end='\r')
-        prev_objects = temp_objects.copy()
-        temp_objects.clear()
+                    #print(f"Adding new object {self.object_id}", end='\r')
+                    tracked_object = detectedObject(self.object_id, self.store, 1)
+                    self.tracked_objects[tracked_object] = None # kept until retire() or finalize() apply min_len
+                    self.object_id += 1
+                    seeded[k] = True
+                tracked_object.length += 1
+                owners[new_index] = tracked_object
+                identities[k] = tracked_object.identity
+
+            velocities = old_array[old_idx, :2] - new_array[new_idx, :2]
+            self.store.extend(identities[seeded], frame_index-1, old_idx[seeded], old_array[old_idx[seeded]], velocities[seeded])
+            self.store.extend(identities, frame_index, new_idx, new_array[new_idx], velocities)
+            new_velocities[new_idx] = velocities
+
+        if len(self.lost) > 0:
+            self.closeGaps(frame_index, new_array, owners, new_velocities)
+        if self.max_gap > 0:
+            for old_index, tracked_object in self.prev_owners.items():
+                self.lost[tracked_object] = (self.prev_frame, old_array[old_index], self.old_velocities[old_index])
+            for tracked_object in [t for t, (frame, _, _) in self.lost.items() if frame_index - frame > self.max_gap]:
+                del self.lost[tracked_object]
+                self.retire(tracked_object)
+        else:
+            for tracked_object in self.prev_owners.values():
+                self.retire(tracked_object)
+
+        self.prev_owners = owners # tracks not extended this frame are retired by dropping them here
+        self.prev_frame = frame_index
+        self.old_array, self.old_velocities = new_array, new_velocities
+
+    def closeGaps(self, frame_index, new_array, owners, new_velocities):
+        """
+        Relink lost tracks to detections of this frame that no track claimed.
+        """
+        unmatched = np.array([slot for slot in range(len(new_array)) if slot not in owners], dtype=np.int64)
+        if len(unmatched) == 0:
+            return
+        lost_tracks = list(self.lost.keys())
+        lost_frames = np.array([self.lost[t][0] for t in lost_tracks])
+        lost_array = np.array([self.lost[t][1] for t in lost_tracks])
+        lost_velocities = np.nan_to_num(np.array([self.lost[t][2] for t in lost_tracks]))
+        steps = frame_index - lost_frames
+        predicted = lost_array.copy()
+        predicted[:, :2] -= lost_velocities * steps[:, None] # velocities are stored as old - new
+        if self.solver == "optimal":
+            new_idx, lost_idx = optimalMatches(predicted, new_array[unmatched])
+        else:
+            new_idx, lost_idx = greedyMatches(predicted, new_array[unmatched], np.ones(len(lost_tracks), dtype=bool))
+        if len(new_idx) == 0:
+            return
+
+        slots = unmatched[new_idx]
+        identities = np.empty(len(slots), dtype=np.int64)
+        for k, (slot, lost_index) in enumerate(zip(slots.tolist(), lost_idx.tolist())):
+            tracked_object = lost_tracks[lost_index]
+            del self.lost[tracked_object]
+            tracked_object.length += 1
+            self.tracked_objects[tracked_object] = None
+            owners[slot] = tracked_object
+            identities[k] = tracked_object.identity
+        velocities = (lost_array[lost_idx, :2] - new_array[slots, :2]) / steps[lost_idx, None] # per-frame velocity across the gap
+        self.store.extend(identities, frame_index, slots, new_array[slots], velocities)
+        new_velocities[slots] = velocities
+
+    def retire(self, tracked_object):
+        """
+        Called once a track can no longer be extended: release it if it is too short.
+        """
+        if len(tracked_object) >= self.min_len:
+            return
+        self.tracked_objects.pop(tracked_object, None)
+        self.released.append(tracked_object.identity)
+        self.released_rows += len(tracked_object)
+        if 2 * self.released_rows > self.store.size: # compact once at least half of the rows are dead
+            self.store.discard(self.released)
+            self.released, self.released_rows = [], 0
+
+    def finalize(self):
+        print(f"\nFiltering by minimum length: {self.min_len}")
+        filtered_objects = [tracked_object for tracked_object in self.tracked_objects.keys() if len(tracked_object) >= self.min_len]
+        print(f"Final length: {len(filtered_objects)}")
+        kept = np.array([tracked_object.identity for tracked_object in filtered_objects], dtype=np.int64)
+        self.store.discard(np.setdiff1d(self.store.column("track"), kept))
+        self.tracked_objects = dict.fromkeys(filtered_objects)
+        self.released, self.released_rows = [], 0
+        self.prev_owners, self.lost = {}, {}
+        self.old_array, self.old_velocities = np.empty((0, 5)), np.empty((0, 2))
+        return filtered_objects
+
+def trackObjects(contours, min_len=30, solver="greedy", predict=False, max_gap=0):
+    """
+    Track a whole video at once: contours maps frame index -> list of box2D.
+    """
+    tracker = onlineTracker(min_len=min_len, solver=solver, predict=predict, max_gap=max_gap)
+    frame_count = len(contours.keys())
+    for frame_index in range(frame_count):
+        tracker.push(frame_index, contours[frame_index])
+        if frame_index > 0:
+            print(f"Total objects found: {tracker.object_id} ({frame_index/(frame_count-1)*100:.2f}%)", end='\r')
+    return tracker.finalize()
+
+def trackChunk(handle, start, stop, solver="greedy", predict=False, max_gap=0):
+    """
+    Process-pool worker for trackChunks: track frames start..stop-1 of the packed
+    boxes shared by handle and return every track fragment, including the short
+    ones, as store columns. Nothing is released here since a short fragment may
+    continue in the next chunk.
+    """
+    with sharedArrays.attach(handle) as shared:
+        offsets = shared["offsets"][start:stop+1].copy()
+        boxes = shared["boxes"][offsets[0]:offsets[-1]].copy()
+    offsets -= offsets[0]
+    tracker = onlineTracker(min_len=0, solver=solver, predict=predict, max_gap=max_gap)
+    for offset in range(stop - start):
+        tracker.push(start + offset, boxes[offsets[offset]:offsets[offset+1]])
+    return trackColumns(tracker.store)
+
+def trackChunks(contours, chunk_size=2000, overlap=50, min_len=30, solver="greedy", predict=False, max_gap=0, max_workers=None, executor=None):
+    """
+    Track one long video on several cores.
+
+    The timeline is cut into chunks of chunk_size frames, each extended by
+    overlap frames (raised to at least 2 * max_gap + 2) into the next chunk,
+    and every chunk is tracked in its own process. Within each overlap a seam
+    frame is picked halfway through, after
+    the later chunk has had overlap // 2 frames to settle. Rows up to and
+    including the seam come from the earlier chunk and rows after it from the
+    later one. Each fragment of the later chunk is joined to the earlier track
+    holding its last detection (frame, slot) at or before the seam, so tracks
+    relinked across a gap over the seam stay whole. Chunks go to executor if given
+    (anything with submit), otherwise to a pool of max_workers processes.
+    """
+    frame_count = len(contours.keys())
+    starts = list(range(0, frame_count, chunk_size))
+    if len(starts) <= 1:
+        return trackObjects(contours, min_len=min_len, solver=solver, predict=predict, max_gap=max_gap)
+    needed = 2 * max_gap + 2 # the later chunk must have seen a lost track for max_gap frames before the seam to relink it
+    overlap = max(1, min(max(overlap, needed), chunk_size))
+    if overlap < needed:
+        raise ValueError(f"chunk_size {chunk_size} is too small for max_gap {max_gap}: chunks must overlap by at least {needed} frames")
+    seams = [start + overlap // 2 for start in starts[1:]] # last frame taken from the earlier chunk
+    print(f"Tracking {frame_count} frames in {len(starts)} chunks...")
+    packed = [cleanBoxes(contours[frame_index])[1] for frame_index in range(frame_count)]
+    offsets = np.concatenate(([0], np.cumsum([len(boxes) for boxes in packed])))
+    shared = sharedArrays.create({"boxes": np.concatenate(packed), "offsets": offsets}) # workers map it, only the handle is pickled
+    del packed
+    pool = executor or ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [pool.submit(trackChunk, shared.handle, start, min(start + chunk_size + overlap, frame_count), solver, predict, max_gap) for start in starts]
+        chunks = [future.result() for future in futures]
+    finally:
+        if executor is None:
+            pool.shutdown(wait=True)
+        shared.unlink()
+
+    offsets = np.cumsum([0] + [chunk["track"].max() + 1 if len(chunk["track"]) > 0 else 0 for chunk in chunks])
+    parent = np.arange(offsets[-1])
+    kept = []
+    for k, chunk in enumerate(chunks):
+        chunk["track"] = chunk["track"] + offsets[k]
+        lower = seams[k-1] if k > 0 else -1
+        upper = seams[k] if k < len(seams) else frame_count
+        keep = (chunk["frame"] > lower) & (chunk["frame"] <= upper)
+        if k > 0:
+            previous = chunks[k-1]
+            prev_rows = np.flatnonzero((previous["frame"] >= starts[k]) & (previous["frame"] <= lower))
+            prev_keys = dict(zip(zip(previous["frame"][prev_rows].tolist(), previous["slot"][prev_rows].tolist()),
+                                 previous["track"][prev_rows].tolist()))
+            for row in np.flatnonzero(chunk["frame"] == lower).tolist():
+                if (lower, int(chunk["slot"][row])) not in prev_keys:
+                    keep[row] = True # detection only tracked by the later chunk
+            # join on the last detection at or before the seam that both chunks tracked, so a
+            # fragment whose gap spans the seam is still joined to the track it continues
+            before = np.flatnonzero(chunk["frame"] <= lower)
+            before = before[np.argsort(-chunk["frame"][before], kind='stable')]
+            joined, matched = set(), set()
+            for row in before.tolist():
+                track = int(chunk["track"][row])
+                owner = prev_keys.get((int(chunk["frame"][row]), int(chunk["slot"][row])))
+                if track in matched or owner is None:
+                    continue
+                matched.add(track)
+                if owner not in joined:
+                    parent[track] = owner
+                    joined.add(owner)
+        kept.append({name: column[keep] for name, column in chunk.items()})
+
+    while True: # resolve chains of joins across several seams
+        roots = parent[parent]
+        if np.array_equal(roots, parent):
+            break
+        parent = roots
+    columns = {name: np.concatenate([chunk[name] for chunk in kept]) for name in kept[0]}
+    _, columns["track"] = np.unique(parent[columns["track"]], return_inverse=True)
+
+    store = storeFromColumns(columns)
+    lengths = np.bincount(store.column("track"))
+    first_frames = np.full(len(lengths), frame_count)
+    np.minimum.at(first_frames, store.column("track"), store.column("frame"))
+    order = np.argsort(first_frames, kind='stable')
 
     print(f"\nFiltering by minimum length: {min_len}")
-    for tracked_object in tracked_objects.keys():
-        if len(tracked_object.box2D) >= 30:
-            filtered_objects.append(tracked_object)
+    filtered_objects = [detectedObject(identity, store, int(lengths[identity])) for identity in order.tolist() if lengths[identity] >= min_len]
+    store.discard(np.flatnonzero((lengths > 0) & (lengths < min_len)))
     print(f"Final length: {len(filtered_objects)}")
     return filtered_objects
 
-def extractData(detect_objects):
-    data=defaultdict(list)
-    for object_detected in detect_objects:
-        for frame in object_detected.frames_in:
-            data[frame].append(str([object_detected.velocities[frame].tolist(),
-                               object_detected.areas[frame].tolist(),
-                               object_detected.positions[frame].tolist()]))
-    max_len = max(len(objects) for objects in data.values()) 
-    
-    for frame, values in data.items():
-        while len(values) < max_len:
-            values.append(np.nan)
-                
-    return pd.DataFrame(data)
+def boxCorners(boxes):
+    """
+    Vectorized cv2.boxPoints: (N, 5) [cx, cy, w, h, angle] -> (N, 4, 2) corners.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+    cx, cy, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    angle = np.radians(boxes[:, 4])
+    b, a = np.cos(angle) * 0.5, np.sin(angle) * 0.5
+    corners = np.empty((len(boxes), 4, 2))
+    corners[:, 0, 0] = cx - a * h - b * w
+    corners[:, 0, 1] = cy + b * h - a * w
+    corners[:, 1, 0] = cx + a * h - b * w
+    corners[:, 1, 1] = cy - b * h - a * w
+    corners[:, 2] = 2 * boxes[:, :2] - corners[:, 0]
+    corners[:, 3] = 2 * boxes[:, :2] - corners[:, 1]
+    return corners
+
+def frameGroups(frames):
+    """
+    Split a frame-sorted array into runs: returns the unique frames, the start
+    of each run and the position of every row within its run.
+    """
+    unique_frames, starts, counts = np.unique(frames, return_index=True, return_counts=True)
+    positions = np.arange(len(frames)) - np.repeat(starts, counts)
+    return unique_frames, starts, positions
+
+def extractData(detect_objects, wide=False):
+    """
+    Tabulate tracked detections.
+
+    By default the result is long format: one row per (track_id, frame), with
+    numeric columns vx, vy, area, x and y, sorted by track and frame. With
+    wide=True the legacy layout is returned instead: one column per frame, one
+    row per object slot, and each cell a "[[vx, vy], area, [x, y]]" string.
+    """
+    if wide:
+        return extractWide(detect_objects)
+    columns = ("track_id", "frame", "vx", "vy", "area", "x", "y")
+    if len(detect_objects) == 0:
+        return pd.DataFrame(columns=columns)
+    store = detect_objects[0].store
+    rows = store.rowsOf([object_detected.identity for object_detected in detect_objects])
+    rows = rows[np.lexsort((store.column("frame")[rows], store.column("track")[rows]))]
+    sources = ("track", "frame", "vx", "vy", "area", "cx", "cy")
+    return pd.DataFrame({name: store.column(source)[rows] for name, source in zip(columns, sources)})
+
+def extractWide(detect_objects):
+    if len(detect_objects) == 0:
+        return pd.DataFrame()
+    store = detect_objects[0].store
+    rows = store.rowsOf([object_detected.identity for object_detected in detect_objects])
+    frames = store.column("frame")[rows]
+    unique_frames, _, positions = frameGroups(frames)
+
+    cells = [str([[vx, vy], area, [x, y]]) for vx, vy, area, x, y in zip(
+        store.column("vx")[rows].tolist(), store.column("vy")[rows].tolist(), store.column("area")[rows].tolist(),
+        store.column("cx")[rows].tolist(), store.column("cy")[rows].tolist())]
+    table = np.full((positions.max() + 1, len(unique_frames)), np.nan, dtype=object)
+    table[positions, np.searchsorted(unique_frames, frames)] = cells
+    return pd.DataFrame(table, columns=unique_frames)
 
 def byFrame(detect_objects):
     contours_by_frame=defaultdict(list)
     ids_by_frame=defaultdict(list)
-    for object_detected in detect_objects:
-        for frame in object_detected.frames_in:
-            box2D = object_detected.box2D[frame]
-            box = cv2.boxPoints(box2D)
-            box = np.intp(box)
-            contours_by_frame[frame].append(box)
-            ids_by_frame[frame].append(object_detected.identity)
+    if len(detect_objects) == 0:
+        return contours_by_frame, ids_by_frame
+    store = detect_objects[0].store
+    rows = store.rowsOf([object_detected.identity for object_detected in detect_objects])
+    boxes = np.column_stack([store.column(name)[rows] for name in ("cx", "cy", "w", "h", "angle")])
+    corners = np.intp(boxCorners(boxes).astype(np.float32))
+    unique_frames, starts, _ = frameGroups(store.column("frame")[rows])
+    identities = store.column("track")[rows]
+    for frame, box_group, id_group in zip(unique_frames.tolist(), np.split(corners, starts[1:]), np.split(identities, starts[1:])):
+        contours_by_frame[frame] = list(box_group)
+        ids_by_frame[frame] = id_group.tolist()
 
     return contours_by_frame, ids_by_frame
 
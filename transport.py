@@ -0,0 +1,74 @@
+"""
+Shared-memory transport of numpy arrays between processes
+"""
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+# what crosses the process boundary: the block name and (name, dtype, shape, offset) per array
+sharedHandle = namedtuple("sharedHandle", ("name", "layout"))
+
+class sharedArrays():
+    """
+    Named numpy arrays packed into one shared memory block.
+
+    The sending process calls sharedArrays.create(arrays) and submits
+    .handle, a few hundred bytes to pickle, instead of the arrays; the worker
+    maps the same pages with sharedArrays.attach(handle). The creator keeps its
+    instance until the worker is done and then calls unlink(). Views into
+    .arrays must be dropped (or copied) before close().
+    """
+    alignment = 64
+
+    def __init__(self, shm, layout, owner=False):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+                       for name, dtype, shape, offset in layout}
+
+    @classmethod
+    def create(cls, arrays):
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        layout, size = [], 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // cls.alignment) * cls.alignment
+        shared = cls(shared_memory.SharedMemory(create=True, size=max(size, 1)), layout, owner=True)
+        for name, array in arrays.items():
+            shared.arrays[name][...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        # pool workers share the creator's resource tracker, so attaching never unlinks the block early
+        return cls(shared_memory.SharedMemory(name=handle.name), handle.layout)
+
+    @property
+    def handle(self):
+        return sharedHandle(self.shm.name, self.layout)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+def receiveArrays(handle):
+    """
+    Copy the arrays behind a handle out of shared memory and detach from it.
+    """
+    with sharedArrays.attach(handle) as shared:
+        return {name: array.copy() for name, array in shared.arrays.items()}
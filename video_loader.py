@@ -2,12 +2,16 @@ from PySide6.QtCore import *
 import os
 import cv2
 from time import sleep
-from videotools import placeLabel, frameDifferencing, nearestOdd
+from videotools import placeLabel, nearestOdd
+from pipeline import applyFilters, frameReader
+from tracking import onlineTracker
+from datatools import detectionWriter
+from resultcache import resultCache
 import numpy as np
 
 class processVideos(QThread):
     frame_out = Signal(np.ndarray)
-    contours_out = Signal(object, str)
+    contours_out = Signal(object, object, str, str)
     name_out = Signal(str, str)
     
     def __init__(self):
@@ -24,6 +28,12 @@ class processVideos(QThread):
         self.pause_mutex = QMutex()
         self.settings_mutex = QMutex()
         self.settings={}
+        self.tracker = None
+        self.writer = None
+        self.reader = None
+        self.save_directory = os.getcwd()
+        self.cache = resultCache()
+        self.cache_keys = None
 
     def loadVideo(self, file):
         try:
@@ -48,6 +58,31 @@ class processVideos(QThread):
         with QMutexLocker(self.pause_mutex):
             self.pause = paused
 
+    @Slot(str)
+    def setSaveDirectory(self, directory):
+        with QMutexLocker(self.init_mutex):
+            self.save_directory = directory
+
+    def loadCached(self, settings, store_path):
+        """
+        Emit cached detections/tracks for the current video and settings, if any.
+        Returns True on a hit, so decoding can be skipped entirely.
+        """
+        try:
+            self.cache_keys = self.cache.keys(self.file, settings)
+        except OSError as e:
+            print(f"Result cache unavailable for {self.name}: {e}")
+            self.cache_keys = None
+            return False
+        tracked_objects = self.cache.loadResult(self.cache_keys, store_path, settings["minTrackLength"])
+        if tracked_objects is None:
+            return False
+        print(f"Using cached detections for: {self.name}")
+        with QMutexLocker(self.init_mutex):
+            self.contours_out.emit(store_path, tracked_objects, self.name, self.file)
+            self.name_out.emit(self.name, self.file)
+        return True
+
     @Slot(dict)
     def loadSettings(self, settings):
         with QMutexLocker(self.settings_mutex):
@@ -56,58 +91,14 @@ class processVideos(QThread):
     @Slot()
     def restartVideo(self):
         with QMutexLocker(self.init_mutex):
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if self.reader is None: # the decode-ahead thread owns the capture while recording
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
 
     def applyFilters(self, frame):
-        boxes, centers, boxes2D = [], [], []
         with QMutexLocker(self.settings_mutex):
             settings = self.settings
-
-        if len(frame.shape) == 3:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-        if settings["blurToggle"]:
-            frame = cv2.GaussianBlur(frame, (settings["blurVal"], settings["blurVal"]), 0)
-        
-        if settings["adaptToggle"]:
-            method = settings["adaptMethod"]
-            if method == "Mean":
-                frame = cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
-                                              settings["adaptArea"], settings["adaptValueC"])
-            elif method == "Gaussian":
-                frame = cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
-                                              settings["adaptArea"], settings["adaptValueC"])
-                
-        if settings["thresholdToggle"]:
-            if settings["autoToggle"]:
-                otsu, frame = cv2.threshold(frame, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-                otsu_normal = int(otsu / 255 * 100)
-            else:
-                _, frame = cv2.threshold(frame, settings["thresholdVal"], 255, cv2.THRESH_BINARY)
-        
-        if settings["subBackToggle"]:
-            method = settings["subBackMethod"]
-            if method == "MOG2":  # Mixture of Gaussians 2
-                frame = settings["subBackModels"][method].apply(frame, learningRate=0.001)
-            if method == "KNN":  # K Nearest Neighbors
-                frame = settings["subBackModels"][method].apply(frame, learningRate=0.01)
-            _, frame = cv2.threshold(frame, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        if settings["embossToggle"]:
-            kernel = np.array([[2, 1, 0], [1, 0, -1], [0, -1, -2]])
-            frame = cv2.convertScaleAbs(cv2.filter2D(frame, -1, kernel) * settings["embossVal"])
-        
-        if settings["invertToggle"]:
-            frame = cv2.bitwise_not(frame)
-        
-        if settings["dilationToggle"]:
-            frame = cv2.dilate(frame, None, iterations=settings["dilateVal"])
-            kernel = np.ones((3, 3), np.uint8)
-            frame = cv2.morphologyEx(frame, cv2.MORPH_OPEN, kernel)
-
-        if settings["frameDiffToggle"]:
-            boxes, centers, boxes2D = frameDifferencing(frame, settings["frameDiffValue"], settings["frameDiffValueMax"])
-
+        subtractor = settings["subBackModels"][settings["subBackMethod"]] if settings["subBackToggle"] else None
+        frame, boxes, centers, boxes2D = applyFilters(frame, settings, subtractor)
         frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
         return frame, boxes, centers, boxes2D, settings
     
@@ -117,7 +108,6 @@ class processVideos(QThread):
         last_tick = 0
         frame_num = 0
         run_once = True
-        detected_objects={}
         while self.running:
             if self.cap is not None:
                 with QMutexLocker(self.init_mutex):
@@ -129,7 +119,7 @@ class processVideos(QThread):
                         pause = self.pause
                     if not pause:
                         start_tick = cv2.getTickCount()
-                        ret, frame = cap.read()
+                        ret, frame = self.reader.read() if self.reader is not None else cap.read()
                         if fps_tick == 0:
                             fps_tick = cv2.getTickCount()
                         if last_tick == 0:
@@ -139,8 +129,16 @@ class processVideos(QThread):
                                 cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
                                 continue
                             else:
+                                self.closeReader()
+                                tracked_objects = self.tracker.finalize() if self.tracker is not None else None
+                                contours = None
+                                if self.writer is not None:
+                                    self.writer.close()
+                                    contours = self.writer.path
+                                    if self.cache_keys is not None:
+                                        self.cache.storeResult(self.cache_keys, contours, tracked_objects)
                                 with QMutexLocker(self.init_mutex):
-                                    self.contours_out.emit(detected_objects, self.name)
+                                    self.contours_out.emit(contours, tracked_objects, self.name, self.file)
                                     self.name_out.emit(self.name, self.file)
                                 return
                         
@@ -167,6 +165,10 @@ class processVideos(QThread):
                         if not settings["batchRecord"]:
                             if not run_once:
                                 run_once = True
+                                self.closeReader()
+                                if self.writer is not None: # recording switched off partway through
+                                    self.writer.discard()
+                                    self.writer = None
                             process_time = (cv2.getTickCount() - start_tick) / tick_freq
                             sleep_time = max(frame_time - process_time, 0)
                             sleep(sleep_time)
@@ -175,12 +177,33 @@ class processVideos(QThread):
                                 cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
                                 frame_num = 0
                                 run_once = False
-                            detected_objects[frame_num]=boxes2D
+                                self.tracker = onlineTracker(min_len=settings["minTrackLength"])
+                                if self.writer is not None:
+                                    self.writer.discard()
+                                with QMutexLocker(self.init_mutex):
+                                    store_path = f'{self.save_directory}/contours/{self.name.split(".")[0]}_c.det'
+                                if self.loadCached(settings, store_path):
+                                    return
+                                self.writer = detectionWriter(store_path) # detections go to disk in chunks while recording
+                                with QMutexLocker(self.init_mutex):
+                                    self.reader = frameReader(cap) # decode the next frames while this one is filtered
+                                continue
+                            self.writer.append(boxes2D)
+                            self.tracker.push(frame_num, boxes2D)
                             frame_num+=1
                 except Exception as e:
                     print(e)
 
+    def closeReader(self):
+        with QMutexLocker(self.init_mutex):
+            reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.close()
+
     def stop(self):
         self.running = False
         self.quit()
-        self.wait()
\ No newline at end of file
+        self.wait()
+        self.closeReader()
+        if self.writer is not None: # a finished store is already in place, an unfinished one is dropped
+            self.writer.discard()
\ No newline at end of file
@@ -6,6 +6,7 @@ import cv2
 from PySide6.QtCore import *
 from PySide6.QtWidgets import *
 from scaleBarUI import Ui_Dialog as ScaleBar_Dialog
+from pipeline import frameDifferencing
 
 class ScaleBar(QDialog, ScaleBar_Dialog): # save position dialog box
     valuesUpdated = Signal(float, float, int, int, int, int, float)
@@ -92,23 +93,6 @@ class ScaleBar(QDialog, ScaleBar_Dialog): # save position dialog box
             self.fontScale_input.value()
         )
 
-def frameDifferencing(frame, area_min: int=25, area_max: int=100):
-    boxes, boxes2D, centers = [], [], []
-    
-    contours, hierarchy = cv2.findContours(frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        if area < area_min or area > area_max * 3:
-            continue
-        box2D = cv2.minAreaRect(contour)
-        box = cv2.boxPoints(box2D)
-        box = np.intp(box)
-        boxes.append(box)
-        boxes2D.append(box2D)
-        centers.append(np.intp(box2D[0]))
-        
-    return boxes, centers, boxes2D
-
 def nearestOdd(n):
     return n if n % 2 == 1 else n + 1
 